@@ -0,0 +1,269 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+import PIL
+from PIL import Image
+
+# Times the Droste render loop and video encoding on synthetic images, and compares the results
+# with a stored baseline so performance changes can be measured instead of guessed.
+# Usage: python benchmarks/bench_render.py [--sizes 512,2k,4k] [--output results.json]
+#        [--baseline benchmarks/render_baseline.json] [--update_baseline] [--pyramid] [--inverse_map] [--codecs x264,x265,vp9,av1]
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPT_DIR)
+
+from droste_core import INVERSE_MAP_RESAMPLING_METHODS, PYRAMID_MIN_PSNR, RESAMPLING_METHODS, process_image_for_droste_effect
+from droste_encoders import VIDEO_CODECS, build_encoder_settings
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'render_baseline.json')
+
+IMAGE_SIZES = {
+    '512': (512, 512),
+    '2k': (2048, 1080),
+    '4k': (3840, 2160),
+}
+
+ROTATION_ANGLES = [0.0, 5.0]
+
+def make_synthetic_image(size, seed=0, noise=6.0):
+    # Smooth gradients, hard-edged shapes and a little noise (its standard deviation), so resampling
+    # filters have both flat areas and detail to work on; the same seed always gives the same pixels
+    width, height = size
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    red = 255 * x / max(1, width - 1)
+    green = 255 * y / max(1, height - 1)
+    blue = 127.5 + 127.5 * np.sin(x / 23.0) * np.cos(y / 31.0)
+    pixels = np.stack([red, green, blue], axis=-1)
+    for _ in range(12):
+        left, top = rng.randint(0, width), rng.randint(0, height)
+        right, bottom = left + rng.randint(width // 20, width // 4), top + rng.randint(height // 20, height // 4)
+        pixels[top:bottom, left:right] = rng.randint(0, 256, 3)
+    if noise:
+        pixels += rng.normal(0, noise, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB')
+
+def time_call(function, repeats):
+    # Median wall time of repeats calls, together with the last call's result
+    times = []
+    result = None
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = function()
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times), times, result
+
+def bench_render(image_path, shrink_factor, max_iterations, resampling_method, rotation_angle, engine, repeats, pyramid=False):
+    def render():
+        with tempfile.TemporaryDirectory() as temp_dir:
+            frame_paths, final_image = process_image_for_droste_effect(
+                image_path, temp_dir, shrink_factor, max_iterations, resampling_method, rotation_angle, engine=engine, pyramid=pyramid)
+            if not frame_paths or final_image is None:
+                raise RuntimeError(f"Rendering failed for {resampling_method} at {rotation_angle} degrees.")
+            return len(frame_paths)
+    return time_call(render, repeats)
+
+def get_psnr(image, reference):
+    error = np.mean((np.asarray(image, dtype=np.float64) - np.asarray(reference, dtype=np.float64)) ** 2)
+    return float('inf') if error == 0 else 10 * np.log10(255.0 ** 2 / error)
+
+def measure_pyramid_quality(image_path, shrink_factor, max_iterations, resampling_method, rotation_angle, engine):
+    # Lowest PSNR of any frame rendered from the pyramid against the full-resolution frame
+    with tempfile.TemporaryDirectory() as full_dir, tempfile.TemporaryDirectory() as pyramid_dir:
+        with contextlib.redirect_stdout(io.StringIO()):
+            full_paths, _ = process_image_for_droste_effect(
+                image_path, full_dir, shrink_factor, max_iterations, resampling_method, rotation_angle, engine=engine)
+            pyramid_paths, _ = process_image_for_droste_effect(
+                image_path, pyramid_dir, shrink_factor, max_iterations, resampling_method, rotation_angle, engine=engine, pyramid=True)
+        lowest = float('inf')
+        for full_path, pyramid_path in zip(full_paths, pyramid_paths):
+            with Image.open(full_path) as full_frame, Image.open(pyramid_path) as pyramid_frame:
+                lowest = min(lowest, get_psnr(pyramid_frame, full_frame))
+        return lowest
+
+def bench_encode(image_path, shrink_factor, max_iterations, fps, engine, repeats, codecs):
+    # Frames are rendered once, outside the timing, so only the encoder is measured. Returns the
+    # median time, the run times and the video size per codec, and the frame count.
+    from droste_video import create_timelapse_video
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with contextlib.redirect_stdout(io.StringIO()):
+            frame_paths, _ = process_image_for_droste_effect(
+                image_path, temp_dir, shrink_factor, max_iterations, 'bilinear', ROTATION_ANGLES[-1], engine=engine)
+        for codec in codecs:
+            video_path = os.path.join(temp_dir, f"timelapse_{codec}.mp4")
+            encoder_settings = build_encoder_settings(codec=codec)
+            median, times, _ = time_call(lambda: create_timelapse_video(frame_paths, video_path, fps, False, encoder_settings), repeats)
+            results[codec] = (median, times, os.path.getsize(video_path))
+        return results, len(frame_paths)
+
+def run_benchmarks(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as image_dir:
+        for size_name in args.sizes:
+            image_path = os.path.join(image_dir, f"synthetic_{size_name}.png")
+            make_synthetic_image(IMAGE_SIZES[size_name]).save(image_path)
+
+            for resampling_method in args.resampling_methods:
+                for rotation_angle in ROTATION_ANGLES:
+                    case = f"render/{size_name}/{resampling_method}/rot{rotation_angle:g}"
+                    median, times, frame_count = bench_render(
+                        image_path, args.shrink_factor, args.max_iterations, resampling_method, rotation_angle, args.engine, args.repeats)
+                    results[case] = {'seconds': round(median, 4), 'runs': [round(t, 4) for t in times], 'frames': frame_count}
+                    print(f"{case:<36}{median:>9.3f} s  ({frame_count} frames)")
+
+                    if args.pyramid:
+                        case = f"{case}/pyramid"
+                        median, times, frame_count = bench_render(
+                            image_path, args.shrink_factor, args.max_iterations, resampling_method, rotation_angle, args.engine, args.repeats, pyramid=True)
+                        psnr = measure_pyramid_quality(image_path, args.shrink_factor, args.max_iterations, resampling_method, rotation_angle, args.engine)
+                        results[case] = {'seconds': round(median, 4), 'runs': [round(t, 4) for t in times], 'frames': frame_count,
+                                         'min_psnr': round(psnr, 2) if psnr != float('inf') else None}
+                        print(f"{case:<36}{median:>9.3f} s  ({frame_count} frames, lowest PSNR {psnr:.1f} dB)")
+
+                    if args.inverse_map and resampling_method in INVERSE_MAP_RESAMPLING_METHODS:
+                        # Timed against the composite render of the same case
+                        composite_seconds = results[f"render/{size_name}/{resampling_method}/rot{rotation_angle:g}"]['seconds']
+                        case = f"render/{size_name}/{resampling_method}/rot{rotation_angle:g}/inverse_map"
+                        median, times, frame_count = bench_render(
+                            image_path, args.shrink_factor, args.max_iterations, resampling_method, rotation_angle, 'inverse_map', args.repeats)
+                        speedup = composite_seconds / median if median else None
+                        results[case] = {'seconds': round(median, 4), 'runs': [round(t, 4) for t in times], 'frames': frame_count,
+                                         'speedup': round(speedup, 2) if speedup else None}
+                        print(f"{case:<36}{median:>9.3f} s  ({frame_count} frames, x{speedup:.2f} against composite)")
+
+            if not args.skip_encode:
+                encode_results, frame_count = bench_encode(image_path, args.shrink_factor, args.max_iterations, args.fps, args.engine, args.repeats, args.codecs)
+                for codec, (median, times, video_bytes) in encode_results.items():
+                    # x264 keeps the case name it had before there was a choice of codec
+                    case = f"encode/{size_name}" if codec == 'x264' else f"encode/{size_name}/{codec}"
+                    results[case] = {'seconds': round(median, 4), 'runs': [round(t, 4) for t in times], 'frames': frame_count, 'bytes': video_bytes}
+                    print(f"{case:<36}{median:>9.3f} s  ({frame_count} frames, {video_bytes} bytes)")
+    return results
+
+def get_environment():
+    # The machine and library versions every case is timed with; the kernel release is left out, as
+    # it changes on the same machine without changing the timings
+    return {
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'numpy': np.__version__,
+        'system': platform.system(),
+        'machine': platform.machine(),
+        'processor': get_processor_name(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def get_processor_name():
+    # platform.processor() is empty on most Linux systems, which name the CPU in /proc/cpuinfo
+    try:
+        with open('/proc/cpuinfo') as cpuinfo_file:
+            for line in cpuinfo_file:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+def compare_with_baseline(results, baseline, tolerance):
+    # A case regresses when it is slower than the baseline by more than the tolerance. Cases are
+    # compared whatever machine they were recorded on, but those recorded elsewhere are flagged.
+    comparison = {}
+    regressions = []
+    for case, result in results.items():
+        if case not in baseline.get('results', {}):
+            continue
+        baseline_seconds = baseline['results'][case]['seconds']
+        ratio = result['seconds'] / baseline_seconds if baseline_seconds else None
+        comparison[case] = {'baseline_seconds': baseline_seconds, 'seconds': result['seconds'], 'ratio': round(ratio, 3) if ratio else None,
+                            'same_environment': baseline['results'][case].get('environment') == result['environment']}
+        if ratio and ratio > 1 + tolerance:
+            regressions.append(case)
+    return comparison, regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Droste rendering and video encoding")
+    parser.add_argument("--sizes", help="Comma-separated image sizes to benchmark", default=','.join(IMAGE_SIZES))
+    parser.add_argument("--resampling_methods", help="Comma-separated resampling methods to benchmark", default=','.join(RESAMPLING_METHODS))
+    parser.add_argument("--shrink_factor", type=float, help="Shrink factor for every render", default=0.9)
+    parser.add_argument("--max_iterations", type=int, help="Maximum number of iterations per render", default=20)
+    parser.add_argument("--fps", type=int, help="Frames per second for the encode benchmark", default=10)
+    parser.add_argument("--engine", help="Frame rendering engine", default='composite')
+    parser.add_argument("--repeats", type=int, help="Timed runs per case; the median is reported", default=3)
+    parser.add_argument("--skip_encode", action='store_true', help="Only benchmark rendering")
+    parser.add_argument("--pyramid", action='store_true', help="Also time every render from the image pyramid and check its quality")
+    parser.add_argument("--inverse_map", action='store_true', help="Also time every render the inverse map engine supports and compare it with the composite engine")
+    parser.add_argument("--codecs", help="Comma-separated video codecs for the encode benchmark", default='x264')
+    parser.add_argument("--output", help="Path for the JSON results", default="")
+    parser.add_argument("--baseline", help="Baseline JSON to compare with", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, help="Allowed slowdown against the baseline before a case counts as a regression", default=0.15)
+    parser.add_argument("--update_baseline", action='store_true', help="Store these results as the new baseline")
+    args = parser.parse_args()
+
+    args.sizes = [size.strip().lower() for size in args.sizes.split(',') if size.strip()]
+    args.resampling_methods = [method.strip().lower() for method in args.resampling_methods.split(',') if method.strip()]
+    args.codecs = [codec.strip().lower() for codec in args.codecs.split(',') if codec.strip()]
+    unknown_sizes = [size for size in args.sizes if size not in IMAGE_SIZES]
+    unknown_methods = [method for method in args.resampling_methods if method not in RESAMPLING_METHODS]
+    unknown_codecs = [codec for codec in args.codecs if codec not in VIDEO_CODECS]
+    if unknown_sizes or unknown_methods or unknown_codecs or args.repeats <= 0:
+        parser.error(f"Sizes must be from {', '.join(IMAGE_SIZES)}, resampling methods from {', '.join(RESAMPLING_METHODS)}, "
+                     f"codecs from {', '.join(VIDEO_CODECS)}, and repeats positive.")
+
+    environment = get_environment()
+    report = {
+        'environment': dict(environment, platform=platform.platform()),
+        'settings': {
+            'shrink_factor': args.shrink_factor,
+            'max_iterations': args.max_iterations,
+            'fps': args.fps,
+            'engine': args.engine,
+            'repeats': args.repeats,
+            'rotation_angles': ROTATION_ANGLES,
+        },
+        'results': run_benchmarks(args),
+    }
+    # Every case keeps the machine it was timed on, so a baseline stays readable case by case
+    for result in report['results'].values():
+        result['environment'] = environment
+
+    # Pyramid renders must stay within the quality tolerance whatever the baseline says
+    regressions = [case for case, result in report['results'].items() if result.get('min_psnr') is not None and result['min_psnr'] < PYRAMID_MIN_PSNR]
+    for case in regressions:
+        print(f"{case}: lowest PSNR {report['results'][case]['min_psnr']} dB is below {PYRAMID_MIN_PSNR} dB")
+    if not args.update_baseline and args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('settings') != report['settings']:
+            print("Warning: the baseline was recorded with different settings; ratios are not comparable.")
+        report['comparison'], slower_cases = compare_with_baseline(report['results'], baseline, args.tolerance)
+        regressions += slower_cases
+        report['regressions'] = regressions
+        print("\nAgainst baseline:")
+        for case, comparison in report['comparison'].items():
+            marker = '  REGRESSION' if case in slower_cases else ''
+            if not comparison['same_environment']:
+                marker += '  (baseline from another machine or library versions)'
+            print(f"{case:<36}{comparison['baseline_seconds']:>9.3f} s -> {comparison['seconds']:.3f} s  (x{comparison['ratio']}){marker}")
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"Results saved as {args.output}")
+    if args.update_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        print(f"Baseline saved as {args.baseline}")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
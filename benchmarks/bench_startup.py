@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from PIL import Image
+
+# Measures how long a still-image-only command-line run takes from process start to exit, and
+# checks that it never imports the GUI toolkit or the video encoder.
+# Usage: python benchmarks/bench_startup.py [--runs N] [--target_seconds S] [--report path.json]
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_PATH = os.path.join(SCRIPT_DIR, 'droste_image_effect_old.py')
+HEAVY_MODULES = ['tkinter', 'moviepy', 'imageio', 'imageio_ffmpeg']
+
+# Runs the CLI in-process and reports which heavy modules were loaded by the time it finished
+IMPORT_PROBE = '''
+import json, os, runpy, sys
+sys.argv = sys.argv[1:]
+# Running the script directly puts its directory first on sys.path; run_path does not
+sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[0])))
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+finally:
+    loaded = sorted({name.split('.')[0] for name in sys.modules} & set(%r))
+    sys.stderr.write('LOADED_MODULES=' + json.dumps(loaded) + '\\n')
+''' % HEAVY_MODULES
+
+def still_image_command(image_path, output_dir):
+    return [SCRIPT_PATH, '--image_path', image_path, '--max_iterations', '3',
+            '--save_timelapse', 'no', '--save_reversed', 'no', '--output_path', output_dir]
+
+def time_run(command, env):
+    start_time = time.perf_counter()
+    completed = subprocess.run([sys.executable] + command, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start_time
+    if completed.returncode != 0:
+        raise RuntimeError(f"Run failed with exit code {completed.returncode}:\n{completed.stdout}{completed.stderr}")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the start-up time of a still-image-only run")
+    parser.add_argument("--runs", type=int, help="Number of timed runs", default=5)
+    parser.add_argument("--target_seconds", type=float, help="Median wall time a run must stay under", default=1.0)
+    parser.add_argument("--report", help="Path for the JSON report", default="")
+    args = parser.parse_args()
+
+    # Without a display, so a run that still touches tkinter fails loudly
+    env = dict(os.environ)
+    env.pop('DISPLAY', None)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        image_path = os.path.join(temp_dir, 'startup.png')
+        Image.new('RGB', (64, 48), (200, 120, 40)).save(image_path)
+        command = still_image_command(image_path, temp_dir)
+
+        probe = subprocess.run([sys.executable, '-c', IMPORT_PROBE] + command, env=env, capture_output=True, text=True)
+        if probe.returncode != 0:
+            raise RuntimeError(f"Probe run failed:\n{probe.stdout}{probe.stderr}")
+        loaded_line = [line for line in probe.stderr.splitlines() if line.startswith('LOADED_MODULES=')][-1]
+        loaded_modules = json.loads(loaded_line.split('=', 1)[1])
+
+        # The interpreter start-up alone, to show how much of a run is this program's own cost
+        interpreter_times = [time_run(['-c', 'pass'], env) for _ in range(args.runs)]
+        run_times = [time_run(command, env) for _ in range(args.runs)]
+
+    median_time = statistics.median(run_times)
+    report = {
+        'runs': args.runs,
+        'interpreter_median_seconds': round(statistics.median(interpreter_times), 4),
+        'median_seconds': round(median_time, 4),
+        'min_seconds': round(min(run_times), 4),
+        'max_seconds': round(max(run_times), 4),
+        'target_seconds': args.target_seconds,
+        'heavy_modules_loaded': loaded_modules,
+        'passed': median_time < args.target_seconds and not loaded_modules,
+    }
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    sys.exit(0 if report['passed'] else 1)
+
+if __name__ == "__main__":
+    main()
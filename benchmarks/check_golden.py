@@ -0,0 +1,242 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import numpy as np
+import PIL
+from PIL import Image
+
+# Golden-image regression check for the Droste renderers. --record renders a matrix of cases with the
+# reference path (the composite engine, one process, full-resolution resampling) and stores every
+# frame, stacked top to bottom in one PNG per case; the last one is the final image. Every run then renders the same cases with each optimized
+# renderer, compares the frames with the stored ones by PSNR and SSIM against per-renderer
+# tolerances, and reports how much faster each renderer is than the reference path.
+# Usage: python benchmarks/check_golden.py [--record] [--renderers pyramid,tiled] [--output report.json]
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from bench_render import get_psnr, make_synthetic_image, time_call
+from droste_core import PYRAMID_MIN_PSNR, generate_droste_frames, load_droste_renderer, open_droste_frame_pool
+
+GOLDEN_DIR = os.path.join(BENCHMARK_DIR, 'golden')
+GOLDEN_MANIFEST = 'golden.json'
+
+# Small enough to keep the golden frames in the repository; the noise the benchmark images get would
+# make them several times larger
+GOLDEN_IMAGE_SIZE = (96, 72)
+GOLDEN_SHRINK_FACTOR = 0.85
+GOLDEN_MAX_ITERATIONS = 12
+
+# Source, resampling method and rotation angle of every recorded case
+GOLDEN_CASES = [
+    ('opaque', 'nearest', 5.0),
+    ('opaque', 'bilinear', 0.0),
+    ('opaque', 'bilinear', 5.0),
+    ('opaque', 'bilinear', 90.0),
+    ('opaque', 'bicubic', -33.0),
+    ('opaque', 'lanczos', 5.0),
+    ('opaque', 'box', 0.0),
+    ('opaque', 'hamming', 5.0),
+    ('translucent', 'bilinear', 5.0),
+    ('translucent', 'lanczos', 0.0),
+]
+
+# Tile edge the tiled renderer is forced to, so the small golden images are split into several tiles
+GOLDEN_TILE_SIZE = 32
+
+# How each renderer is built, and the lowest PSNR (dB) and SSIM any of its frames may have against
+# the golden frames; None means the frames must match exactly. methods and sources limit a renderer
+# to the cases it reproduces. The inverse map samples rotated layers in one pass instead of resizing
+# and then rotating them, so its pixels differ slightly; with the wider filters it falls back to the
+# composite engine and must match exactly.
+GOLDEN_RENDERERS = {
+    'reference': {'options': {}, 'min_psnr': None, 'min_ssim': None},
+    'workers': {'options': {'workers': 2}, 'min_psnr': None, 'min_ssim': None},
+    'pyramid': {'options': {'pyramid': True}, 'min_psnr': PYRAMID_MIN_PSNR, 'min_ssim': 0.99},
+    'tiled': {'options': {'max_memory_mb': 256, 'tile_size': GOLDEN_TILE_SIZE}, 'min_psnr': 40.0, 'min_ssim': 0.99},
+    'inverse_map': {'options': {'engine': 'inverse_map'}, 'min_psnr': 25.0, 'min_ssim': 0.95},
+}
+
+def make_golden_source(kind):
+    # The synthetic benchmark image, made translucent with a radial alpha falloff for the translucent cases
+    image = make_synthetic_image(GOLDEN_IMAGE_SIZE, noise=0).convert('RGBA')
+    if kind == 'translucent':
+        width, height = GOLDEN_IMAGE_SIZE
+        y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+        distance = np.hypot((x - width / 2) / width, (y - height / 2) / height)
+        alpha = np.clip(255 * (1.2 - 2 * distance), 0, 255).astype(np.uint8)
+        image.putalpha(Image.fromarray(alpha, 'L'))
+    return image
+
+def get_case_name(source, resampling_method, rotation_angle):
+    return f"{source}/{resampling_method}/rot{rotation_angle:g}"
+
+def get_case_path(golden_dir, case):
+    return os.path.join(golden_dir, case.replace('/', '_') + '.png')
+
+def load_golden_frames(golden_dir, case, frame_count):
+    with Image.open(get_case_path(golden_dir, case)) as strip:
+        strip_pixels = np.asarray(strip.convert('RGBA'))
+    return strip_pixels.reshape(frame_count, -1, strip_pixels.shape[1], 4)
+
+def box_mean(values, window):
+    # Mean of every window x window block, from an integral image
+    integral = np.pad(values.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    sums = integral[window:, window:] - integral[:-window, window:] - integral[window:, :-window] + integral[:-window, :-window]
+    return sums / (window * window)
+
+def get_ssim(image, reference, window=7):
+    # Mean structural similarity over uniform window x window blocks, averaged over the channels
+    image = np.asarray(image, dtype=np.float64)
+    reference = np.asarray(reference, dtype=np.float64)
+    window = min(window, image.shape[0], image.shape[1])
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    scores = []
+    for channel in range(image.shape[2]):
+        a, b = image[..., channel], reference[..., channel]
+        mean_a, mean_b = box_mean(a, window), box_mean(b, window)
+        variance_a = box_mean(a * a, window) - mean_a ** 2
+        variance_b = box_mean(b * b, window) - mean_b ** 2
+        covariance = box_mean(a * b, window) - mean_a * mean_b
+        ssim_map = ((2 * mean_a * mean_b + c1) * (2 * covariance + c2)) / ((mean_a ** 2 + mean_b ** 2 + c1) * (variance_a + variance_b + c2))
+        scores.append(ssim_map.mean())
+    return float(np.mean(scores))
+
+def render_golden_frames(image_path, resampling_method, rotation_angle, options):
+    # Every frame the renderer outputs, as RGBA arrays
+    renderer = load_droste_renderer(image_path, GOLDEN_SHRINK_FACTOR, GOLDEN_MAX_ITERATIONS, resampling_method, rotation_angle,
+                                    options.get('engine', 'composite'), options.get('max_memory_mb'), pyramid=options.get('pyramid', False))
+    if 'tile_size' in options:
+        renderer.tile_size = options['tile_size']
+    frames = []
+    with open_droste_frame_pool(renderer, options.get('workers', 1)) as frame_pool:
+        for _, frame in generate_droste_frames(image_path, GOLDEN_SHRINK_FACTOR, GOLDEN_MAX_ITERATIONS, resampling_method, rotation_angle,
+                                               renderer, frame_pool):
+            # The canvas may be updated in place, so every frame is copied
+            frames.append(np.array(frame if frame.mode == 'RGBA' else frame.convert('RGBA')))
+    return np.stack(frames)
+
+def record_golden(golden_dir):
+    os.makedirs(golden_dir, exist_ok=True)
+    for source in sorted({source for source, _, _ in GOLDEN_CASES}):
+        make_golden_source(source).save(os.path.join(golden_dir, f"source_{source}.png"))
+    cases = {}
+    for source, resampling_method, rotation_angle in GOLDEN_CASES:
+        case = get_case_name(source, resampling_method, rotation_angle)
+        with contextlib.redirect_stdout(io.StringIO()):
+            frames = render_golden_frames(os.path.join(golden_dir, f"source_{source}.png"), resampling_method, rotation_angle, {})
+        Image.fromarray(frames.reshape(-1, frames.shape[2], 4), 'RGBA').save(get_case_path(golden_dir, case), optimize=True)
+        cases[case] = {'source': source, 'resampling_method': resampling_method, 'rotation_angle': rotation_angle, 'frames': len(frames)}
+        print(f"{case:<32}{len(frames):>4} frames recorded")
+
+    manifest = {
+        'environment': {'python': platform.python_version(), 'pillow': PIL.__version__, 'numpy': np.__version__},
+        'settings': {'image_size': list(GOLDEN_IMAGE_SIZE), 'shrink_factor': GOLDEN_SHRINK_FACTOR, 'max_iterations': GOLDEN_MAX_ITERATIONS},
+        'cases': cases,
+    }
+    with open(os.path.join(golden_dir, GOLDEN_MANIFEST), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    print(f"Golden frames saved in {golden_dir}")
+
+def compare_frames(frames, golden_frames):
+    # Lowest PSNR and SSIM of any frame, and those of the final image; None if the frame counts or sizes differ
+    if frames.shape != golden_frames.shape:
+        return None
+    psnrs = [get_psnr(frame, golden) for frame, golden in zip(frames, golden_frames)]
+    ssims = [get_ssim(frame, golden) if not np.array_equal(frame, golden) else 1.0 for frame, golden in zip(frames, golden_frames)]
+    return {
+        'identical': bool(np.array_equal(frames, golden_frames)),
+        'min_psnr': min(psnrs), 'final_psnr': psnrs[-1],
+        'min_ssim': min(ssims), 'final_ssim': ssims[-1],
+    }
+
+def within_tolerance(comparison, renderer):
+    if comparison is None:
+        return False
+    if renderer['min_psnr'] is None:
+        return comparison['identical']
+    return bool(comparison['min_psnr'] >= renderer['min_psnr'] and comparison['min_ssim'] >= renderer['min_ssim'])
+
+def format_db(psnr):
+    return 'inf' if psnr == float('inf') else f"{psnr:.1f}"
+
+def check_golden(golden_dir, renderer_names, repeats):
+    with open(os.path.join(golden_dir, GOLDEN_MANIFEST)) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest['environment']['pillow'] != PIL.__version__:
+        print(f"Warning: the golden frames were recorded with Pillow {manifest['environment']['pillow']}; "
+              f"re-record them with --record if the reference path no longer matches exactly.")
+
+    results = {}
+    failures = []
+    for case, case_info in manifest['cases'].items():
+        image_path = os.path.join(golden_dir, f"source_{case_info['source']}.png")
+        resampling_method, rotation_angle = case_info['resampling_method'], case_info['rotation_angle']
+        golden_frames = load_golden_frames(golden_dir, case, case_info['frames'])
+        reference_seconds, _, _ = time_call(lambda: render_golden_frames(image_path, resampling_method, rotation_angle, {}), repeats)
+
+        for renderer_name in renderer_names:
+            renderer = GOLDEN_RENDERERS[renderer_name]
+            if resampling_method not in renderer.get('methods', (resampling_method,)) or case_info['source'] not in renderer.get('sources', (case_info['source'],)):
+                continue
+            seconds, _, frames = time_call(lambda: render_golden_frames(image_path, resampling_method, rotation_angle, renderer['options']), repeats)
+            comparison = compare_frames(frames, golden_frames)
+            passed = within_tolerance(comparison, renderer)
+            key = f"{case}/{renderer_name}"
+            results[key] = {
+                'frames': len(frames), 'golden_frames': len(golden_frames),
+                'tolerance': {'min_psnr': renderer['min_psnr'], 'min_ssim': renderer['min_ssim']},
+                'seconds': round(seconds, 4), 'reference_seconds': round(reference_seconds, 4),
+                'speedup': round(reference_seconds / seconds, 3) if seconds else None,
+                'passed': passed,
+            }
+            if comparison is None:
+                quality = f"{len(frames)} frames instead of {len(golden_frames)}"
+            else:
+                # Infinite PSNRs are stored as null, which JSON can represent
+                results[key]['identical'] = comparison['identical']
+                results[key].update({name: (None if value == float('inf') else round(float(value), 4))
+                                     for name, value in comparison.items() if name != 'identical'})
+                tolerance = 'exact' if renderer['min_psnr'] is None else f">= {renderer['min_psnr']:g} dB, >= {renderer['min_ssim']:g}"
+                quality = (f"PSNR min {format_db(comparison['min_psnr'])} final {format_db(comparison['final_psnr'])} dB, "
+                           f"SSIM min {comparison['min_ssim']:.4f} (tolerance {tolerance})")
+            if not passed:
+                failures.append(key)
+            print(f"{key:<44}{quality}, x{results[key]['speedup']} speedup{'' if passed else '  FAILED'}")
+    return results, failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Check Droste renderers against golden frames from the reference path")
+    parser.add_argument("--record", action='store_true', help="Render and store the golden frames with the reference path")
+    parser.add_argument("--golden_dir", help="Directory of the golden frames", default=GOLDEN_DIR)
+    parser.add_argument("--renderers", help="Comma-separated renderers to check", default=','.join(GOLDEN_RENDERERS))
+    parser.add_argument("--repeats", type=int, help="Timed runs per render; the median is reported", default=3)
+    parser.add_argument("--output", help="Path for the JSON results", default="")
+    args = parser.parse_args()
+
+    if args.record:
+        record_golden(args.golden_dir)
+        return
+
+    renderer_names = [name.strip().lower() for name in args.renderers.split(',') if name.strip()]
+    unknown_renderers = [name for name in renderer_names if name not in GOLDEN_RENDERERS]
+    if unknown_renderers or args.repeats <= 0:
+        parser.error(f"Renderers must be from {', '.join(GOLDEN_RENDERERS)}, and repeats positive.")
+    if not os.path.isfile(os.path.join(args.golden_dir, GOLDEN_MANIFEST)):
+        parser.error(f"No golden frames in {args.golden_dir}; record them with --record first.")
+
+    results, failures = check_golden(args.golden_dir, renderer_names, args.repeats)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'results': results, 'failures': failures}, output_file, indent=2)
+        print(f"Results saved as {args.output}")
+    if failures:
+        print(f"\n{len(failures)} of {len(results)} checks outside their tolerance.")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
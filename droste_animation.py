@@ -0,0 +1,240 @@
+import io
+import os
+import struct
+import zlib
+from PIL import GifImagePlugin, ImageChops
+from droste_profile import profile_file, profile_stage
+
+# Lossy quality and effort of animated WebP frames, Pillow's defaults for a single WebP image
+WEBP_QUALITY = 80
+WEBP_METHOD = 4
+
+# GIF frames share a palette of this many colours, taken from the first frame; with transparency
+# the last index of the 256 is kept for transparent pixels
+GIF_PALETTE_COLORS = 255
+GIF_TRANSPARENT_INDEX = 255
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def get_changed_box(previous, frame):
+    # Bounding box of the pixels that differ between two frames, or None if they are identical
+    difference = ImageChops.difference(previous, frame)
+    if difference.mode == 'RGBA':
+        # getbbox only looks at the alpha band of an RGBA image
+        red, green, blue, alpha = difference.split()
+        difference = ImageChops.lighter(ImageChops.lighter(red, green), ImageChops.lighter(blue, alpha))
+    return difference.getbbox()
+
+class AnimationWriter:
+    # Writes an animation one frame at a time, so memory use does not grow with the frame count.
+    # Each frame is added with the slot (in frames at the animation's frame rate) it starts at.
+    # Only the box that changed since the frame before is kept, a frame identical to the one before
+    # it just keeps that one on screen longer, and a frame is written once the next different frame
+    # (or close) fixes how long it shows.
+    def __init__(self, output_path, fps, drop_duplicates=False):
+        self.output_path = output_path
+        self.fps = fps
+        self.drop_duplicates = drop_duplicates
+        self.mode = None
+        self.previous = None
+        self.pending = None
+        self.frames_written = 0
+        self.output_file = open(output_path, 'wb')
+
+    def add_frame(self, frame, slot):
+        with profile_stage('animation', slot):
+            if self.mode is None:
+                # The canvas is RGBA even for an opaque source, whose animation needs no alpha
+                translucent = 'A' in frame.getbands() and frame.getchannel('A').getextrema()[0] < 255
+                self.mode = 'RGBA' if translucent else 'RGB'
+                self.start(frame.size)
+            if frame.mode != self.mode:
+                frame = frame.convert(self.mode)
+            if self.previous is None:
+                box = (0, 0) + frame.size
+            else:
+                box = get_changed_box(self.previous, frame)
+                if box is None:
+                    return
+            data = self.prepare_frame(frame, box)
+            if self.pending is not None:
+                self.write_pending(slot)
+            self.pending = (slot, box, data)
+            # The frame may be the renderer's canvas, which is drawn on in place
+            self.previous = frame.copy()
+
+    def write_pending(self, end_slot):
+        slot, box, data = self.pending
+        self.write_frame(slot, box, data, max(1, end_slot - slot))
+        self.frames_written += 1
+        self.pending = None
+
+    def close(self, end_slot):
+        with profile_stage('animation'):
+            if self.pending is not None:
+                self.write_pending(end_slot)
+            if self.mode is not None:
+                self.finish()
+            self.output_file.close()
+        profile_file('animation', self.output_path)
+        print(f"Animation saved as {self.output_path} ({self.frames_written} frames).")
+
+    def discard(self):
+        # Removes an animation that was never finished; a finished one is left alone
+        if self.output_file.closed:
+            return
+        self.output_file.close()
+        if os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+    def get_duration_ms(self, slots):
+        return 1000.0 * slots / self.fps
+
+class GifAnimationWriter(AnimationWriter):
+    def start(self, size):
+        self.palette_image = None
+
+    def quantize(self, frame):
+        quantized = frame.convert('RGB').quantize(palette=self.palette_image)
+        if self.mode == 'RGBA':
+            # Pixels only ever get more opaque as layers are added, so transparent pixels in a
+            # changed box never have to show through to a previously opaque one
+            quantized.paste(GIF_TRANSPARENT_INDEX, mask=frame.getchannel('A').point(lambda alpha: 255 if alpha < 128 else 0))
+        return quantized
+
+    def prepare_frame(self, frame, box):
+        if self.palette_image is None:
+            # Every frame reuses the first frame's palette, which the global colour table holds
+            self.palette_image = frame.convert('RGB').quantize(colors=GIF_PALETTE_COLORS)
+            header, _ = GifImagePlugin.getheader(self.palette_image.copy(), info={'loop': 0})
+            for block in header:
+                self.output_file.write(block)
+        return self.quantize(frame.crop(box))
+
+    def write_frame(self, slot, box, data, slots):
+        params = {'duration': round(self.get_duration_ms(slots) / 10) * 10, 'disposal': 1}
+        if self.mode == 'RGBA':
+            params['transparency'] = GIF_TRANSPARENT_INDEX
+        for block in GifImagePlugin.getdata(data, offset=box[:2], **params):
+            self.output_file.write(block)
+
+    def finish(self):
+        self.output_file.write(b';')
+
+def write_png_chunk(output_file, chunk_type, data):
+    output_file.write(struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+def read_png_chunks(png_data):
+    position = len(PNG_SIGNATURE)
+    while position < len(png_data):
+        length, chunk_type = struct.unpack('>I4s', png_data[position:position + 8])
+        yield chunk_type, png_data[position + 8:position + 8 + length]
+        position += 12 + length
+
+class ApngAnimationWriter(AnimationWriter):
+    # Every frame but the first covers only its changed box, drawn over the frame before it
+    def start(self, size):
+        self.sequence_number = 0
+        self.header = None
+
+    def prepare_frame(self, frame, box):
+        # Pillow encodes the box as a PNG, whose image data becomes the frame's data
+        png_buffer = io.BytesIO()
+        frame.crop(box).save(png_buffer, 'PNG', compress_level=6)
+        chunks = list(read_png_chunks(png_buffer.getvalue()))
+        if self.header is None:
+            self.header = next(data for chunk_type, data in chunks if chunk_type == b'IHDR')
+            self.output_file.write(PNG_SIGNATURE)
+            write_png_chunk(self.output_file, b'IHDR', self.header)
+            # The frame count is filled in once all frames are written
+            self.frame_count_offset = self.output_file.tell() + 8
+            write_png_chunk(self.output_file, b'acTL', struct.pack('>II', 0, 0))
+        return [data for chunk_type, data in chunks if chunk_type == b'IDAT']
+
+    def write_frame(self, slot, box, data, slots):
+        left, top, right, bottom = box
+        write_png_chunk(self.output_file, b'fcTL', struct.pack(
+            '>IIIIIHHBB', self.sequence_number, right - left, bottom - top, left, top, slots, self.fps, 0, 0))
+        self.sequence_number += 1
+        for image_data in data:
+            if self.frames_written == 0:
+                # The first frame is also the image shown by viewers without APNG support
+                write_png_chunk(self.output_file, b'IDAT', image_data)
+            else:
+                write_png_chunk(self.output_file, b'fdAT', struct.pack('>I', self.sequence_number) + image_data)
+                self.sequence_number += 1
+
+    def finish(self):
+        write_png_chunk(self.output_file, b'IEND', b'')
+        self.output_file.seek(self.frame_count_offset)
+        actl_data = struct.pack('>II', self.frames_written, 0)
+        self.output_file.write(actl_data + struct.pack('>I', zlib.crc32(b'acTL' + actl_data) & 0xffffffff))
+
+class WebpAnimationWriter(AnimationWriter):
+    # libwebp's animation encoder finds the changed boxes itself, so it is given whole frames; it
+    # keeps only the compressed frames until the file is assembled. The encoder is Pillow's private
+    # binding, whose interface changes between releases; where it is missing or differs, the frames
+    # are kept and written with Pillow's public save_all path instead, which holds them uncompressed.
+    def start(self, size):
+        self.frames = None
+        try:
+            from PIL import _webp
+            self.encoder = _webp.WebPAnimEncoder(size[0], size[1], 0, 0, False, 3, 5, False, False)
+        except (ImportError, AttributeError, TypeError):
+            self.use_save_all()
+
+    def use_save_all(self):
+        self.encoder = None
+        self.frames = []
+        self.durations = []
+
+    def prepare_frame(self, frame, box):
+        # The frame may be the renderer's canvas, which is drawn on in place
+        return frame.copy()
+
+    def write_frame(self, slot, box, data, slots):
+        start_ms = round(self.get_duration_ms(slot))
+        self.end_ms = round(self.get_duration_ms(slot + slots))
+        if self.encoder is not None:
+            raw_mode = 'RGBX' if self.mode == 'RGB' else 'RGBA'
+            try:
+                self.encoder.add(data.tobytes('raw', raw_mode), start_ms, data.size[0], data.size[1],
+                                 raw_mode, False, WEBP_QUALITY, WEBP_METHOD)
+                return
+            except TypeError:
+                if self.frames_written > 0:
+                    raise
+                self.use_save_all()
+        self.frames.append(data)
+        self.durations.append(self.end_ms - start_ms)
+
+    def finish(self):
+        if self.encoder is None:
+            self.frames[0].save(self.output_file, 'WEBP', save_all=True, append_images=self.frames[1:], duration=self.durations,
+                                loop=0, quality=WEBP_QUALITY, method=WEBP_METHOD, kmin=3, kmax=5)
+            return
+        self.encoder.add(None, self.end_ms, 0, 0, '', False, WEBP_QUALITY, 0)
+        webp_data = self.encoder.assemble('', '', '')
+        if webp_data is None:
+            raise OSError("Cannot write the animation as WebP.")
+        self.output_file.write(webp_data)
+
+ANIMATION_WRITERS = {
+    'webp': WebpAnimationWriter,
+    'apng': ApngAnimationWriter,
+    'gif': GifAnimationWriter,
+}
+
+def open_animation_writer(animation_format, output_path, fps, drop_duplicates=False):
+    # With drop_duplicates, frames left out as duplicates are left out of the animation's timing
+    # too; otherwise the frame before them is held in their place
+    return ANIMATION_WRITERS[animation_format](output_path, fps, drop_duplicates)
+
+def write_droste_animation(frames, writer, frame_count):
+    # Passes the frames through while adding them to the animation
+    written = 0
+    for iteration, frame in frames:
+        writer.add_frame(frame, written if writer.drop_duplicates else iteration)
+        written += 1
+        yield iteration, frame
+    writer.close(written if writer.drop_duplicates else frame_count)
@@ -0,0 +1,249 @@
+import csv
+import glob
+import json
+import os
+import sys
+import time
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from droste_core import DROSTE_ENGINES, DUPLICATE_FRAME_MODES, VALID_IMAGE_EXTENSIONS, build_animation_path, build_output_paths, create_droste_image_effect, parse_float, parse_int, validate_animation_format, validate_parameters
+from droste_checkpoint import validate_resume
+from droste_encoders import build_encoder_settings
+
+# Parameters a batch manifest may set per image; anything left out uses the command-line value
+BATCH_JOB_PARAMETERS = [
+    'shrink_factor', 'max_iterations', 'save_timelapse', 'fps', 'include_reverse', 'save_reversed',
+    'resampling_method', 'rotation_angle', 'output_format', 'output_path', 'engine', 'stream_frames',
+    'cache_dir', 'cache_size_mb', 'max_memory_mb', 'min_layer_size', 'change_epsilon', 'duplicate_frames',
+    'pyramid', 'video_encoder', 'codec', 'preset', 'crf', 'encoder_threads', 'pix_fmt', 'animation_format',
+    'resume',
+]
+
+# Batch worker processes are replaced after this many jobs to return their memory
+BATCH_JOBS_PER_WORKER = 10
+
+def get_worker_recycling_options():
+    # ProcessPoolExecutor only replaces workers after a number of tasks on Python 3.11 and newer;
+    # older versions keep their workers for the whole run
+    if sys.version_info >= (3, 11):
+        return {'max_tasks_per_child': BATCH_JOBS_PER_WORKER}
+    return {}
+
+def load_batch_jobs(batch_source):
+    # A batch is a directory of images, a glob pattern, or a JSON/CSV manifest of per-image parameters
+    if os.path.isdir(batch_source):
+        names = sorted(os.listdir(batch_source))
+        return name_batch_outputs([{'image_path': os.path.join(batch_source, name)} for name in names
+                                   if os.path.splitext(name)[1].lower() in VALID_IMAGE_EXTENSIONS])
+
+    extension = os.path.splitext(batch_source)[1].lower()
+    if extension in ('.json', '.csv') and os.path.isfile(batch_source):
+        with open(batch_source, newline='') as manifest_file:
+            if extension == '.json':
+                manifest = json.load(manifest_file)
+                if isinstance(manifest, dict):
+                    if 'jobs' not in manifest:
+                        raise ValueError(f"Batch manifest {batch_source} has no \"jobs\" list.")
+                    entries = manifest['jobs']
+                else:
+                    entries = manifest
+                if not isinstance(entries, list):
+                    raise ValueError(f"Batch manifest {batch_source} must hold a list of jobs.")
+            else:
+                # Empty cells fall back to the command-line values
+                entries = [{key: value for key, value in row.items() if value not in (None, '')} for row in csv.DictReader(manifest_file)]
+
+        # Image paths in a manifest are relative to the manifest itself
+        manifest_dir = os.path.dirname(os.path.abspath(batch_source))
+        jobs = []
+        for entry in entries:
+            if not isinstance(entry, (str, dict)):
+                raise ValueError(f"Batch manifest entry {entry!r} must be an image path or an object of parameters.")
+            job = {'image_path': entry} if isinstance(entry, str) else dict(entry)
+            if job.get('image_path'):
+                job['image_path'] = os.path.join(manifest_dir, job['image_path'])
+            jobs.append(job)
+        return name_batch_outputs(jobs)
+
+    image_paths = sorted(glob.glob(batch_source, recursive=True))
+    return name_batch_outputs([{'image_path': image_path} for image_path in image_paths
+                               if os.path.splitext(image_path)[1].lower() in VALID_IMAGE_EXTENSIONS])
+
+def get_batch_output_name(job):
+    return job.get('output_name') or os.path.splitext(os.path.basename(job['image_path']))[0]
+
+def name_batch_outputs(jobs):
+    # Jobs run in parallel, so no two of them may write the same files. Jobs whose outputs would
+    # share a name, such as images with the same file name in different directories, get their job
+    # number appended to it.
+    def get_output_key(job):
+        return job.get('output_path') or None, get_batch_output_name(job).lower()
+
+    named_jobs = [(number, job) for number, job in enumerate(jobs, 1) if isinstance(job.get('image_path'), str) and job['image_path']]
+    key_counts = {}
+    for _, job in named_jobs:
+        key_counts[get_output_key(job)] = key_counts.get(get_output_key(job), 0) + 1
+    for number, job in named_jobs:
+        if key_counts[get_output_key(job)] > 1:
+            job['output_name'] = f"{get_batch_output_name(job)}_{number}"
+
+    # An appended number can still meet another image's own name
+    seen = set()
+    for _, job in named_jobs:
+        if get_output_key(job) in seen:
+            raise ValueError(f"More than one batch job would write the outputs named {get_batch_output_name(job)}; give them different output_name values.")
+        seen.add(get_output_key(job))
+    return jobs
+
+def prepare_batch_job(job, defaults):
+    # Validates a job against the same rules as the command line, and returns the positional and
+    # keyword arguments of create_droste_image_effect together with the paths of every output
+    unknown_parameters = set(job) - {'image_path', 'output_name'} - set(BATCH_JOB_PARAMETERS)
+    if unknown_parameters:
+        raise ValueError(f"Unknown batch parameters: {', '.join(sorted(unknown_parameters))}")
+    if not job.get('image_path'):
+        raise ValueError("Every batch job needs an image_path.")
+    output_name = job.get('output_name')
+    if output_name is not None and (not isinstance(output_name, str) or not output_name or os.path.basename(output_name) != output_name):
+        raise ValueError("An output_name must be a file name without a directory.")
+    params = dict(defaults)
+    params.update(job)
+
+    validated_params = validate_parameters(
+        params['image_path'],
+        str(params['shrink_factor']), str(params['max_iterations']), str(params['save_timelapse']),
+        str(params['fps']), str(params['include_reverse']), str(params['save_reversed']),
+        str(params['resampling_method']), str(params['rotation_angle']), str(params['output_format']),
+        params['output_path'], 'output_format' in job
+    )
+    engine = params['engine']
+    if engine not in DROSTE_ENGINES:
+        raise ValueError(f"Invalid engine. Choose from {', '.join(DROSTE_ENGINES)}.")
+    stream_frames = str(params['stream_frames']).lower() in ['yes', 'true']
+    cache_size_mb = parse_int(str(params['cache_size_mb']), "Cache size")
+    if cache_size_mb <= 0:
+        raise ValueError("Cache size must be a positive integer.")
+    max_memory_mb = parse_int(str(params['max_memory_mb']), "Max memory")
+    if max_memory_mb < 0:
+        raise ValueError("Max memory must be zero or a positive integer.")
+    if max_memory_mb and engine != 'composite':
+        raise ValueError("A memory ceiling is only supported by the composite engine.")
+    min_layer_size = parse_int(str(params['min_layer_size']), "Min layer size")
+    if min_layer_size <= 0:
+        raise ValueError("Min layer size must be a positive integer.")
+    change_epsilon = parse_float(str(params['change_epsilon']), "Change epsilon")
+    if change_epsilon < 0:
+        raise ValueError("Change epsilon must be zero or a positive number.")
+    duplicate_frames = str(params['duplicate_frames']).lower()
+    if duplicate_frames not in DUPLICATE_FRAME_MODES:
+        raise ValueError(f"Invalid duplicate frames mode. Choose from {', '.join(DUPLICATE_FRAME_MODES)}.")
+    pyramid = str(params['pyramid']).lower() in ['yes', 'true']
+    if pyramid and (engine != 'composite' or max_memory_mb):
+        raise ValueError("The image pyramid is only supported by the composite engine without a memory ceiling.")
+    encoder_settings = build_encoder_settings(str(params['video_encoder']).lower(), params['codec'], params['preset'], params['crf'],
+                                              params['encoder_threads'], params['pix_fmt'])
+    animation_format = validate_animation_format(params['animation_format'])
+    resume = str(params['resume']).lower() in ['yes', 'true']
+    validate_resume(resume, duplicate_frames, animation_format)
+
+    output_image_path, timelapse_video_path, reversed_clip_path = build_output_paths(
+        params['image_path'], params['output_path'], validated_params['output_format'],
+        validated_params['save_timelapse'], validated_params['save_reversed'], output_name)
+
+    return (
+        params['image_path'], output_image_path, validated_params['shrink_factor'], validated_params['max_iterations'],
+        validated_params['save_timelapse'], validated_params['fps'], validated_params['include_reverse'], timelapse_video_path,
+        reversed_clip_path, validated_params['save_reversed'],
+        validated_params['resampling_method'], validated_params['rotation_angle'], validated_params['output_format'],
+    ), dict(
+        stream_frames=stream_frames, engine=engine,
+        cache_dir=params['cache_dir'] or None, cache_size_mb=cache_size_mb,
+        max_memory_mb=max_memory_mb or None,
+        min_layer_size=min_layer_size, change_epsilon=change_epsilon, duplicate_frames=duplicate_frames,
+        pyramid=pyramid, encoder_settings=encoder_settings, animation_format=animation_format, resume=resume
+    ), (output_image_path, timelapse_video_path, reversed_clip_path, build_animation_path(output_image_path, animation_format))
+
+def run_batch_job(job, defaults):
+    start_time = time.time()
+    result = {'image_path': job.get('image_path'), 'status': 'failed', 'outputs': [], 'error': None}
+    try:
+        args, kwargs, output_paths = prepare_batch_job(job, defaults)
+        success = create_droste_image_effect(*args, **kwargs)
+        result['status'] = 'ok' if success else 'failed'
+        if not success:
+            result['error'] = "Rendering did not complete; see the log output for details."
+        result['outputs'] = [path for path in output_paths if path and os.path.exists(path)]
+    except ValueError as e:
+        result['status'] = 'invalid'
+        result['error'] = str(e)
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
+    result['elapsed'] = round(time.time() - start_time, 3)
+    return result
+
+def run_batch(jobs, defaults, batch_workers, report_path=None):
+    # Jobs run in separate worker processes, at most batch_workers at a time; workers are recycled
+    # after a number of jobs so memory held by one large image is handed back, and a job that
+    # crashes its worker is reported as failed without stopping the rest of the batch
+    start_time = time.time()
+    results = [None] * len(jobs)
+    attempts = [0] * len(jobs)
+    waiting = deque(range(len(jobs)))
+    pending = {}
+
+    def retry_or_fail(index):
+        # Jobs caught up in a worker crash get one more attempt
+        if attempts[index] < 2:
+            waiting.append(index)
+        else:
+            results[index] = {'image_path': jobs[index].get('image_path'), 'status': 'failed', 'outputs': [],
+                              'error': "The worker process running this job exited unexpectedly.", 'elapsed': None}
+
+    def new_executor():
+        return ProcessPoolExecutor(max_workers=batch_workers, **get_worker_recycling_options())
+
+    executor = new_executor()
+    try:
+        while waiting or pending:
+            while waiting and len(pending) < batch_workers:
+                index = waiting.popleft()
+                attempts[index] += 1
+                pending[executor.submit(run_batch_job, jobs[index], defaults)] = index
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            pool_broken = False
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    results[index] = future.result()
+                except BrokenProcessPool:
+                    pool_broken = True
+                    retry_or_fail(index)
+                else:
+                    print(f"[{sum(result is not None for result in results)}/{len(jobs)}] {results[index]['status']}: {results[index]['image_path']}")
+
+            if pool_broken:
+                for index in pending.values():
+                    retry_or_fail(index)
+                pending.clear()
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = new_executor()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+    summary = {
+        'total': len(jobs),
+        'succeeded': sum(result['status'] == 'ok' for result in results),
+        'failed': sum(result['status'] != 'ok' for result in results),
+        'elapsed': round(time.time() - start_time, 3),
+        'jobs': results,
+    }
+    print(f"Batch complete: {summary['succeeded']} succeeded, {summary['failed']} failed in {summary['elapsed']:.2f} seconds.")
+    if report_path:
+        with open(report_path, 'w') as report_file:
+            json.dump(summary, report_file, indent=2)
+        print(f"Batch summary saved as {report_path}")
+    return summary
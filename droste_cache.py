@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import traceback
+from PIL import Image
+from droste_core import plan_video_outputs, save_image_with_format
+
+# Bump when the rendered frames for the same parameters change, so stale entries are never served
+RENDER_CACHE_VERSION = 1
+
+DEFAULT_CACHE_SIZE_MB = 2048
+
+# Staging directories left behind by interrupted runs are removed after this many seconds
+STALE_STAGING_SECONDS = 3600
+
+def hash_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_directory_size(path):
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                total += os.path.getsize(os.path.join(dir_path, file_name))
+            except OSError:
+                pass
+    return total
+
+class DrosteRenderCache:
+    # On-disk cache of finished renders. Each entry is a directory named after a hash of the source
+    # image bytes and of the parameters that change the frames. It holds the final image as a lossless
+    # PNG, the frame stream as numbered PNGs, and every video already encoded from that stream, so a
+    # repeated request is served by copying or re-encoding instead of rendering again. Entries are
+    # evicted least recently used first once the cache grows past max_bytes.
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def make_key(self, image_path, shrink_factor, max_iterations, resampling_method, rotation_angle, engine, max_memory_mb=None, min_layer_size=1, change_epsilon=0.0, duplicate_frames='keep', pyramid=False):
+        params = {
+            'version': RENDER_CACHE_VERSION,
+            'source': hash_file(image_path),
+            'shrink_factor': shrink_factor,
+            'max_iterations': max_iterations,
+            'resampling_method': resampling_method.lower(),
+            'rotation_angle': rotation_angle,
+            'engine': engine,
+            # Memory-bounded renders draw in tiles whose size depends on the ceiling
+            'max_memory_mb': max_memory_mb or 0,
+            # Early stopping and dropped duplicates change which frames are kept
+            'min_layer_size': min_layer_size,
+            'change_epsilon': change_epsilon,
+            'duplicate_frames': duplicate_frames,
+            'pyramid': pyramid,
+        }
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def video_name(self, passes, fps, encoder_settings=None):
+        # fps and the encoder settings only change the encoded videos, so they are part of their
+        # name rather than of the key
+        from droste_encoders import describe_encoder_settings
+        encoder_tag = describe_encoder_settings(encoder_settings)
+        return f"{'-'.join(passes)}_{fps}fps{'_' + encoder_tag if encoder_tag else ''}.mp4"
+
+    def load_entry(self, key):
+        entry_dir = self.entry_dir(key)
+        final_path = os.path.join(entry_dir, 'final.png')
+        if not os.path.isfile(final_path):
+            return None
+
+        frame_dir = os.path.join(entry_dir, 'frames')
+        frame_paths = []
+        if os.path.isdir(frame_dir):
+            frame_paths = [os.path.join(frame_dir, name) for name in sorted(os.listdir(frame_dir))]
+        video_dir = os.path.join(entry_dir, 'videos')
+        videos = {}
+        if os.path.isdir(video_dir):
+            videos = {name: os.path.join(video_dir, name) for name in os.listdir(video_dir) if not name.startswith('.')}
+
+        # The entry directory's modification time records when it was last used
+        os.utime(entry_dir)
+        return {'final_path': final_path, 'frame_paths': frame_paths, 'videos': videos}
+
+    def new_frame_dir(self):
+        return tempfile.mkdtemp(prefix='.staging-', dir=self.cache_dir)
+
+    def restore(self, key, output_path, output_format, fps, include_reverse, timelapse_video_path, reversed_clip_path, save_reversed, duplicate_frames='keep', encoder_settings=None, animation_format='none', animation_path=None, max_memory_mb=None):
+        # Serve a request from the cache. Returns False when the entry cannot produce every requested
+        # output, in which case the caller renders as usual.
+        try:
+            entry = self.load_entry(key)
+            if entry is None:
+                return False
+
+            outputs = plan_video_outputs(timelapse_video_path, reversed_clip_path, include_reverse, save_reversed)
+            missing_outputs = [(path, passes) for path, passes in outputs if self.video_name(passes, fps, encoder_settings) not in entry['videos']]
+            if (missing_outputs or animation_path) and (not entry['frame_paths'] or duplicate_frames == 'retime'):
+                # Cached frames do not record which duplicates were skipped, which re-timing needs
+                return False
+
+            with Image.open(entry['final_path']) as final_image:
+                if not save_image_with_format(final_image, output_path, output_format):
+                    return False
+
+            for path, passes in outputs:
+                if (path, passes) not in missing_outputs:
+                    shutil.copyfile(entry['videos'][self.video_name(passes, fps, encoder_settings)], path)
+
+            if missing_outputs:
+                # Re-encode only the videos that have not been made at this frame rate and with these encoder settings yet
+                from droste_video import encode_video_outputs, get_reverse_buffer_bytes, load_video_frame
+                frame_paths = entry['frame_paths']
+                frame_passes = {
+                    'forward': lambda: (load_video_frame(frame_path) for frame_path in frame_paths),
+                    'reverse': lambda: (load_video_frame(frame_path) for frame_path in reversed(frame_paths)),
+                }
+                encode_video_outputs(missing_outputs, frame_passes, fps, encoder_settings=encoder_settings,
+                                     reverse_buffer_bytes=get_reverse_buffer_bytes(max_memory_mb))
+                self.store(key, videos=[(path, passes, fps) for path, passes in missing_outputs], encoder_settings=encoder_settings)
+
+            if animation_path:
+                # Animations are cheap to write from the cached frames, so they are not cached themselves
+                from droste_animation import open_animation_writer
+                animation_writer = open_animation_writer(animation_format, animation_path, fps, duplicate_frames == 'drop')
+                try:
+                    for slot, frame_path in enumerate(entry['frame_paths']):
+                        with Image.open(frame_path) as frame:
+                            animation_writer.add_frame(frame, slot)
+                    animation_writer.close(len(entry['frame_paths']))
+                finally:
+                    animation_writer.discard()
+
+            print(f"Restored from render cache: {self.entry_dir(key)}")
+            return True
+        except Exception as e:
+            print(f"Error restoring from render cache: {e}")
+            traceback.print_exc()
+            return False
+
+    def store(self, key, final_image=None, frame_dir=None, frame_paths=None, videos=(), encoder_settings=None):
+        # Add whatever a render produced to its entry. Files are written next to their final name and
+        # moved into place, so concurrent runs sharing a cache never see half-written entries.
+        try:
+            entry_dir = self.entry_dir(key)
+            os.makedirs(entry_dir, exist_ok=True)
+
+            if final_image is not None:
+                final_path = os.path.join(entry_dir, 'final.png')
+                staging_path = os.path.join(entry_dir, f".final-{os.getpid()}.png")
+                final_image.save(staging_path)
+                os.replace(staging_path, final_path)
+
+            if frame_paths and frame_dir is None:
+                frame_dir = self.new_frame_dir()
+                for iteration, frame_path in enumerate(frame_paths):
+                    with Image.open(frame_path) as frame:
+                        frame.save(os.path.join(frame_dir, f"frame_{iteration:05d}.png"), compress_level=1)
+            if frame_dir is not None:
+                try:
+                    os.rename(frame_dir, os.path.join(entry_dir, 'frames'))
+                except OSError:
+                    # Another run already stored the same frames
+                    shutil.rmtree(frame_dir, ignore_errors=True)
+
+            if videos:
+                video_dir = os.path.join(entry_dir, 'videos')
+                os.makedirs(video_dir, exist_ok=True)
+                for path, passes, fps in videos:
+                    video_name = self.video_name(passes, fps, encoder_settings)
+                    staging_path = os.path.join(video_dir, f".{os.getpid()}-{video_name}")
+                    shutil.copyfile(path, staging_path)
+                    os.replace(staging_path, os.path.join(video_dir, video_name))
+
+            os.utime(entry_dir)
+            self.evict(keep=key)
+        except Exception as e:
+            print(f"Error storing render in cache: {e}")
+            traceback.print_exc()
+
+    def evict(self, keep=None):
+        entries = []
+        total_size = 0
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if not os.path.isdir(path):
+                continue
+            if name.startswith('.staging-'):
+                if now - os.path.getmtime(path) > STALE_STAGING_SECONDS:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            size = get_directory_size(path)
+            total_size += size
+            entries.append((os.path.getmtime(path), name, size))
+
+        # Least recently used entries go first; the entry just written goes last, and only if it alone is too big
+        for _, name, size in sorted(entries, key=lambda entry: (entry[1] == keep, entry[0])):
+            if total_size <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+            total_size -= size
+            print(f"Evicted render cache entry: {name}")
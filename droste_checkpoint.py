@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import traceback
+from PIL import Image
+from droste_core import load_droste_renderer, print_chosen_parameters, save_image_with_format
+from droste_profile import profile_file, profile_stage
+
+# Bump when checkpoints written by older versions can no longer be continued
+CHECKPOINT_VERSION = 1
+
+CHECKPOINT_STATE_FILE = 'checkpoint.json'
+CHECKPOINT_CANVAS_FILE = 'canvas.png'
+
+def build_checkpoint_dir(image_path, output_image_path, params):
+    # The checkpoint sits in the output directory, named after the source and a hash of the render
+    # parameters rather than after the final image, whose default name changes with every run
+    params_hash = hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    base_filename = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(os.path.dirname(output_image_path), f"{base_filename}_{params_hash}_checkpoint")
+
+def validate_resume(resume, duplicate_frames, animation_format):
+    if not resume:
+        return
+    if duplicate_frames == 'retime':
+        raise ValueError("Resuming cannot be combined with retimed duplicate frames; use keep or drop.")
+    if animation_format != 'none':
+        raise ValueError("Resuming cannot be combined with an animation format.")
+
+def make_checkpoint_params(image_path, shrink_factor, resampling_method, rotation_angle, engine, max_memory_mb, pyramid, fps, duplicate_frames, encoder_settings):
+    # Everything that changes the frames already rendered or how their video segments were encoded.
+    # max_iterations, min_layer_size and change_epsilon only decide where the animation ends, which
+    # is what a resumed run changes.
+    from droste_cache import hash_file
+    from droste_encoders import DEFAULT_ENCODER_SETTINGS
+    return {
+        'version': CHECKPOINT_VERSION,
+        'source': hash_file(image_path),
+        'shrink_factor': shrink_factor,
+        'resampling_method': resampling_method.lower(),
+        'rotation_angle': rotation_angle,
+        'engine': engine,
+        'max_memory_mb': max_memory_mb or 0,
+        'pyramid': pyramid,
+        'fps': fps,
+        'duplicate_frames': duplicate_frames,
+        'encoder_settings': dict(DEFAULT_ENCODER_SETTINGS, **(encoder_settings or {})),
+    }
+
+def load_checkpoint(checkpoint_dir, params, passes, max_iterations):
+    # The saved state if the render can continue from it, or None (with the reason printed)
+    state_path = os.path.join(checkpoint_dir, CHECKPOINT_STATE_FILE)
+    if not os.path.isfile(state_path):
+        return None
+    try:
+        with open(state_path, 'r') as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable checkpoint {state_path}: {e}")
+        return None
+    if state.get('params') != params:
+        print("Starting over: the checkpoint was rendered from a different image or with different parameters.")
+        return None
+    if state['frame_count'] > max_iterations:
+        print(f"Starting over: the checkpoint already has {state['frame_count']} iterations, more than the {max_iterations} asked for.")
+        return None
+    for pass_name in passes:
+        segments = state['segments'].get(pass_name)
+        if segments is None or not all(os.path.isfile(os.path.join(checkpoint_dir, name)) for name in segments):
+            print(f"Starting over: the checkpoint has no {pass_name} video segments.")
+            return None
+    if not os.path.isfile(os.path.join(checkpoint_dir, CHECKPOINT_CANVAS_FILE)):
+        print("Starting over: the checkpoint has no composite.")
+        return None
+    return state
+
+def save_checkpoint(checkpoint_dir, state, canvas):
+    # The state is replaced last, so an interrupted save leaves the previous checkpoint usable
+    # (the composite it refers to is only replaced once the new one is complete)
+    canvas_path = os.path.join(checkpoint_dir, CHECKPOINT_CANVAS_FILE)
+    state_path = os.path.join(checkpoint_dir, CHECKPOINT_STATE_FILE)
+    with profile_stage('checkpoint'):
+        canvas.save(canvas_path + '.tmp', 'PNG')
+        with open(state_path + '.tmp', 'w') as state_file:
+            json.dump(state, state_file, indent=2)
+        os.replace(canvas_path + '.tmp', canvas_path)
+        os.replace(state_path + '.tmp', state_path)
+    profile_file('checkpoint', canvas_path)
+
+def remove_checkpoint_files(checkpoint_dir):
+    for file_name in os.listdir(checkpoint_dir):
+        os.remove(os.path.join(checkpoint_dir, file_name))
+
+def create_resumed_droste_image_effect(image_path, output_path, shrink_factor, max_iterations, save_timelapse, fps, include_reverse, timelapse_video_path, reversed_clip_path, save_reversed, resampling_method, rotation_angle, output_format, max_frames_in_flight, workers=1, engine='composite', max_memory_mb=None, min_layer_size=1, change_epsilon=0.0, duplicate_frames='keep', pyramid=False, encoder_settings=None):
+    # Renders like the streaming pipeline, but keeps a checkpoint next to the outputs: the composite
+    # of the last frame, the size and accumulated rotation of its layer, the iteration it stopped at,
+    # and the video segments encoded so far. A later run with more iterations continues from the
+    # checkpoint, encodes only the new frames as new segments, and joins the segments into the videos
+    # without re-encoding the ones that were already there.
+    from droste_encoders import concat_video_segments
+    from droste_video import stream_droste_effect_to_videos
+    checkpoint_dir = None
+    # The reversed clip runs backwards over every segment, so it is built from reversed segments
+    passes = (['forward'] if save_timelapse else []) + (['reverse'] if save_reversed or (save_timelapse and include_reverse) else [])
+    new_segments = []
+    try:
+        params = make_checkpoint_params(image_path, shrink_factor, resampling_method, rotation_angle, engine, max_memory_mb, pyramid,
+                                        fps, duplicate_frames, encoder_settings)
+        checkpoint_dir = build_checkpoint_dir(image_path, output_path, params)
+        state = load_checkpoint(checkpoint_dir, params, passes, max_iterations)
+        resume_state = None
+        if state is not None:
+            with Image.open(os.path.join(checkpoint_dir, CHECKPOINT_CANVAS_FILE)) as canvas_file:
+                resume_state = (state['frame_count'], canvas_file.convert('RGBA'))
+
+        renderer = load_droste_renderer(image_path, shrink_factor, max_iterations, resampling_method, rotation_angle, engine, max_memory_mb,
+                                        min_layer_size, change_epsilon, duplicate_frames != 'keep', pyramid, resume_state)
+        if state is not None:
+            last_layer = renderer.layers[state['frame_count'] - 1]
+            if list(last_layer['size']) != state['current_size'] or last_layer['rotation'] != state['total_rotation']:
+                print("Starting over: the checkpoint's layer geometry does not match this render.")
+                state = None
+                renderer = load_droste_renderer(image_path, shrink_factor, max_iterations, resampling_method, rotation_angle, engine, max_memory_mb,
+                                                min_layer_size, change_epsilon, duplicate_frames != 'keep', pyramid)
+        if state is None:
+            # Whatever an earlier checkpoint held can no longer be continued
+            if os.path.isdir(checkpoint_dir):
+                remove_checkpoint_files(checkpoint_dir)
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            state = {'version': CHECKPOINT_VERSION, 'params': params, 'frame_count': 0, 'segments': {pass_name: [] for pass_name in passes}}
+        else:
+            print(f"Resuming from iteration {state['frame_count']} of the checkpoint in {checkpoint_dir}.")
+
+        first_frame = state['frame_count']
+        written_frames = [index for index in range(first_frame, renderer.frame_count) if index not in renderer.skipped_frames]
+        if renderer.frame_count > first_frame and not (passes and written_frames):
+            # Without videos, or when every new frame is a dropped duplicate, only the last frame is needed
+            final_image = renderer.render_frame(renderer.frame_count - 1)
+            print(f"Rendered iterations {first_frame} to {renderer.frame_count - 1}.")
+        elif renderer.frame_count > first_frame:
+            segment_paths = {}
+            for pass_name in passes:
+                segment_name = f"{pass_name}_{len(state['segments'][pass_name]):04d}.mp4"
+                segment_paths[pass_name] = os.path.join(checkpoint_dir, segment_name)
+                new_segments.append(segment_name)
+            final_image = stream_droste_effect_to_videos(
+                image_path, segment_paths.get('forward'), segment_paths.get('reverse'), fps, False, 'reverse' in segment_paths,
+                shrink_factor, max_iterations, resampling_method, rotation_angle, max_frames_in_flight, workers, engine, None,
+                max_memory_mb, min_layer_size, change_epsilon, duplicate_frames, pyramid, encoder_settings, renderer=renderer)
+            if final_image is None:
+                return False
+            print(f"Rendered iterations {first_frame} to {renderer.frame_count - 1}.")
+        elif first_frame > 0:
+            print("The checkpoint already has every iteration asked for; nothing new to render.")
+            final_image = resume_state[1]
+        else:
+            print("No iterations to render.")
+            return False
+
+        with profile_stage('final_save'):
+            saved = save_image_with_format(final_image, output_path, output_format)
+        if not saved:
+            print("Failed to save the final image.")
+            return False
+        profile_file('final_image', output_path)
+        print("Image processing complete.")
+
+        for pass_name, segment_name in zip(passes, new_segments):
+            state['segments'][pass_name].append(segment_name)
+        with profile_stage('encode'):
+            if save_timelapse:
+                timelapse_segments = state['segments']['forward'] + (state['segments']['reverse'][::-1] if include_reverse else [])
+                concat_video_segments([os.path.join(checkpoint_dir, name) for name in timelapse_segments], timelapse_video_path)
+                profile_file('videos', timelapse_video_path)
+                print(f"Time-lapse video saved as {timelapse_video_path}")
+            if save_reversed:
+                concat_video_segments([os.path.join(checkpoint_dir, name) for name in state['segments']['reverse'][::-1]], reversed_clip_path)
+                profile_file('videos', reversed_clip_path)
+                print(f"Reversed clip saved as {reversed_clip_path}")
+
+        if renderer.frame_count > first_frame:
+            # Segments of a pass this run did not extend no longer cover every frame
+            stale_segments = [name for pass_name in list(state['segments']) if pass_name not in passes for name in state['segments'].pop(pass_name)]
+            last_layer = renderer.layers[renderer.frame_count - 1]
+            state['frame_count'] = renderer.frame_count
+            state['current_size'] = list(last_layer['size'])
+            state['total_rotation'] = last_layer['rotation']
+            save_checkpoint(checkpoint_dir, state, final_image)
+            for segment_name in stale_segments:
+                os.remove(os.path.join(checkpoint_dir, segment_name))
+            print(f"Checkpoint saved in {checkpoint_dir} at iteration {renderer.frame_count}.")
+        new_segments = []
+        print_chosen_parameters(shrink_factor, max_iterations, save_timelapse, fps, include_reverse, save_reversed, resampling_method, rotation_angle)
+        return True
+    except Exception as e:
+        print(f"An error occurred during image processing: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        # Segments of a run that did not finish are never referred to by the checkpoint
+        for segment_name in new_segments:
+            segment_path = os.path.join(checkpoint_dir, segment_name)
+            if os.path.exists(segment_path):
+                os.remove(segment_path)
@@ -0,0 +1,1124 @@
+import datetime
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from multiprocessing import shared_memory
+import numpy as np
+from PIL import Image, ImageChops, ImageStat
+from droste_profile import is_profiling, merge_profile_timings, profile_file, profile_frame, profile_stage, start_profiling, stop_profiling
+
+# Rendering, validation and still-image output. Nothing here needs a display or a video encoder:
+# the video and GUI modules are only imported once a run actually asks for them.
+
+VALID_IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.bmp', '.webp']
+
+def cleanup_temp_dir(temp_dir):
+    try:
+        shutil.rmtree(temp_dir)
+        print(f"Temporary files cleaned up: {temp_dir}")
+    except Exception as e:
+        print(f"Error cleaning up temporary files: {e}")
+        traceback.print_exc()
+
+# Mapping string input to PIL resampling methods
+RESAMPLING_METHODS = {
+    "nearest": Image.Resampling.NEAREST,
+    "box": Image.Resampling.BOX,
+    "bilinear": Image.Resampling.BILINEAR,
+    "hamming": Image.Resampling.HAMMING,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
+# Default memory budget for resized and rotated layers kept by a compositor
+LAYER_CACHE_BYTES = 256 * 1024 * 1024
+
+# Lowest PSNR, in dB, any frame rendered from the image pyramid may have against the same frame
+# resampled from the full-resolution source; checked by benchmarks/bench_render.py --pyramid
+PYRAMID_MIN_PSNR = 45.0
+
+def get_pil_resampling_method(resampling_method):
+    return RESAMPLING_METHODS.get(resampling_method.lower(), Image.Resampling.BILINEAR)
+
+def get_rotated_layer_size(size, angle):
+    # Size of a layer rotated with expand=True, computed the same way PIL computes it
+    angle = angle % 360.0
+    width, height = size
+    if angle in (0, 180):
+        return size
+    if angle in (90, 270):
+        return (height, width)
+    return get_layer_rotation_matrix(size, angle)[1]
+
+def get_layer_rotation_matrix(size, angle):
+    # The affine map from a rotated (expand=True) layer back to the unrotated one, and the rotated
+    # size, computed the same way PIL's rotate computes them
+    width, height = size
+    radians = -math.radians(angle)
+    a, b = round(math.cos(radians), 15), round(math.sin(radians), 15)
+    d, e = round(-math.sin(radians), 15), round(math.cos(radians), 15)
+    center_x, center_y = width / 2.0, height / 2.0
+    c = a * -center_x + b * -center_y + 0.0 + center_x
+    f = d * -center_x + e * -center_y + 0.0 + center_y
+    corners = ((0, 0), (width, 0), (width, height), (0, height))
+    xs = [a * x + b * y + c for x, y in corners]
+    ys = [d * x + e * y + f for x, y in corners]
+    rotated_width = math.ceil(max(xs)) - math.floor(min(xs))
+    rotated_height = math.ceil(max(ys)) - math.floor(min(ys))
+    shift_x, shift_y = -(rotated_width - width) / 2.0, -(rotated_height - height) / 2.0
+    c, f = a * shift_x + b * shift_y + c, d * shift_x + e * shift_y + f
+    return (a, b, c, d, e, f), (rotated_width, rotated_height)
+
+def compute_droste_layer_geometry(image_size, shrink_factor, rotation_angle, max_iterations):
+    # Geometry of every nested layer: layer k is the source scaled by shrink_factor**(k + 1),
+    # rotated by the accumulated angle and centred on the canvas. Sizes are truncated step by step
+    # exactly like the iterative loop, so composites built from this geometry match it pixel for pixel.
+    layers = []
+    current_size = image_size
+    total_rotation = 0
+    for iteration in range(max_iterations):
+        if current_size[0] <= 1 or current_size[1] <= 1:
+            break
+        layer_size = (int(current_size[0] * shrink_factor), int(current_size[1] * shrink_factor))
+        if layer_size[0] < 1 or layer_size[1] < 1:
+            break
+        total_rotation = (total_rotation + rotation_angle) % 360
+        rotated_size = get_rotated_layer_size(layer_size, total_rotation)
+        layers.append({
+            'size': layer_size,
+            'scale': shrink_factor ** (iteration + 1),
+            'rotation': total_rotation,
+            'rotated_size': rotated_size,
+            'offset': ((image_size[0] - rotated_size[0]) // 2, (image_size[1] - rotated_size[1]) // 2),
+        })
+        current_size = layer_size
+    return layers
+
+def premask_droste_layer(layer_image):
+    # The layer as it looks pasted onto a transparent image with itself as the mask, which is what
+    # gets blended onto the canvas. Done once when a layer is rendered rather than on every composite.
+    premasked_image = Image.new('RGBA', layer_image.size, (0, 0, 0, 0))
+    premasked_image.paste(layer_image, (0, 0), layer_image)
+    return premasked_image
+
+def composite_droste_layer(canvas, layer_image, offset, measure_change=False, opaque=False):
+    # Blends a premasked layer straight into the canvas; the paste is clipped to the canvas, so the
+    # work and the memory touched scale with the layer, not the canvas. Opaque layers would blend to
+    # themselves, so they are copied. With measure_change, returns the sum of absolute channel
+    # differences the layer made.
+    left, top = max(0, offset[0]), max(0, offset[1])
+    right = min(canvas.size[0], offset[0] + layer_image.size[0])
+    bottom = min(canvas.size[1], offset[1] + layer_image.size[1])
+    if right <= left or bottom <= top:
+        return 0
+    box = (left, top, right, bottom)
+
+    previous_region = canvas.crop(box) if measure_change else None
+    if opaque:
+        canvas.paste(layer_image, offset)
+    else:
+        canvas.paste(layer_image, offset, layer_image)
+    if measure_change:
+        return sum(ImageStat.Stat(ImageChops.difference(previous_region, canvas.crop(box))).sum)
+    return None
+
+class DrosteCompositor:
+    # Builds any frame of the Droste animation directly from the source image. Frame N is the
+    # source with layers 0..N drawn on top, so it needs at most N + 1 layer draws of geometrically
+    # shrinking area, and no frame depends on previously rendered frames.
+    def __init__(self, source_image, shrink_factor, max_iterations, resampling_method, rotation_angle, layer_cache_bytes=LAYER_CACHE_BYTES, pyramid=False):
+        self.source_image = source_image if source_image.mode == 'RGBA' else source_image.convert('RGBA')
+        self.shrink_factor = shrink_factor
+        self.max_iterations = max_iterations
+        self.resampling_method = resampling_method
+        self.rotation_angle = rotation_angle
+        self.pil_resampling_method = get_pil_resampling_method(resampling_method)
+        self.layers = compute_droste_layer_geometry(self.source_image.size, shrink_factor, rotation_angle, max_iterations)
+        # Resizing and turning by multiples of 90 degrees keep an opaque source opaque
+        self.source_opaque = self.source_image.getextrema()[3][0] == 255
+        self.frame_count = len(self.layers)
+        self.layer_cache_bytes = layer_cache_bytes
+        self.layer_cache = OrderedDict()
+        self.layer_cache_size = 0
+        # Layers rendered elsewhere (e.g. shared with worker processes), used before the cache
+        self.prepared_layers = {}
+        # Frames left out of the output, such as duplicates of the frame before them
+        self.skipped_frames = set()
+        # Set when limit_droste_frames ends the animation before the layers run out
+        self.stopped_early = False
+        # Frames before resume_frame were rendered by an earlier run, which left the composite of the
+        # last of them in resume_canvas
+        self.resume_frame = 0
+        self.resume_canvas = None
+        # Nearest-neighbour resizing only picks pixels, so it is as cheap from the full source and
+        # would look different from averaged pyramid levels
+        self.pyramid = pyramid and self.pil_resampling_method != Image.Resampling.NEAREST
+        self.pyramid_levels = None
+
+    def get_resize_source(self, size):
+        # With a pyramid, layers are resampled from the smallest level that is still at least twice
+        # as large as the layer (four times for box resampling, whose averaging windows line up with
+        # source pixels), instead of from the full-resolution source every time; with less headroom,
+        # the averaged levels visibly soften detailed sources. Levels halve the previous one by
+        # averaging 2x2 blocks, and are built once, on first use.
+        if not self.pyramid:
+            return self.source_image
+        if self.pyramid_levels is None:
+            with profile_stage('pyramid'):
+                # Levels of a translucent source are averaged with premultiplied alpha, like resize does
+                level = self.source_image
+                if self.source_image.getextrema()[3][0] < 255:
+                    level = self.source_image.convert('RGBa')
+                self.pyramid_levels = [self.source_image]
+                while level.size[0] >= 2 and level.size[1] >= 2:
+                    level = level.reduce(2)
+                    self.pyramid_levels.append(level)
+        headroom = 4 if self.pil_resampling_method == Image.Resampling.BOX else 2
+        for level in reversed(self.pyramid_levels):
+            if level.size[0] >= headroom * size[0] and level.size[1] >= headroom * size[1]:
+                return level
+        return self.source_image
+
+    def render_layer(self, index):
+        if index in self.prepared_layers:
+            return self.prepared_layers[index]
+        if index in self.layer_cache:
+            self.layer_cache.move_to_end(index)
+            return self.layer_cache[index]
+
+        rotated_image = self.build_layer(index)
+        layer_bytes = rotated_image.size[0] * rotated_image.size[1] * 4
+        if layer_bytes <= self.layer_cache_bytes:
+            self.layer_cache[index] = rotated_image
+            self.layer_cache_size += layer_bytes
+            while self.layer_cache_size > self.layer_cache_bytes:
+                _, evicted = self.layer_cache.popitem(last=False)
+                self.layer_cache_size -= evicted.size[0] * evicted.size[1] * 4
+        return rotated_image
+
+    def build_layer(self, index):
+        # The layer resized, rotated and premasked, ready to be blended onto the canvas
+        layer = self.layers[index]
+        with profile_stage('resize', index):
+            resized_image = self.get_resize_source(layer['size']).resize(layer['size'], self.pil_resampling_method)
+            if resized_image.mode == 'RGBa':
+                resized_image = resized_image.convert('RGBA')
+        # Rotate the image by the accumulated angle with a transparent background
+        rotated_image = resized_image
+        if layer['rotation'] != 0:
+            with profile_stage('rotate', index):
+                rotated_image = resized_image.rotate(layer['rotation'], expand=True, fillcolor=(0, 0, 0, 0))
+        if not self.is_layer_opaque(index):
+            with profile_stage('composite', index):
+                rotated_image = premask_droste_layer(rotated_image)
+        return rotated_image
+
+    def is_layer_opaque(self, index):
+        return self.source_opaque and self.layers[index]['rotation'] % 90 == 0
+
+    def draw_layer(self, canvas, index, measure_change=False):
+        layer_image = self.render_layer(index)
+        with profile_stage('composite', index):
+            return composite_droste_layer(canvas, layer_image, self.layers[index]['offset'], measure_change, self.is_layer_opaque(index))
+
+    def new_canvas(self):
+        return self.source_image.copy()
+
+    def resume_from(self, frame_index, canvas):
+        # Continue from the composite of frame frame_index - 1 instead of drawing its layers again
+        self.resume_frame = frame_index
+        self.resume_canvas = canvas if canvas.mode == 'RGBA' else canvas.convert('RGBA')
+
+    def render_frame(self, frame_index):
+        if not 0 <= frame_index < self.frame_count:
+            raise IndexError(f"Frame {frame_index} is out of range for {self.frame_count} frames.")
+        if self.resume_canvas is not None and frame_index >= self.resume_frame - 1:
+            canvas = self.resume_canvas.copy()
+            first_layer = self.resume_frame
+        else:
+            canvas = self.new_canvas()
+            first_layer = 0
+        for index in range(first_layer, frame_index + 1):
+            self.draw_layer(canvas, index)
+        return canvas
+
+    def iter_frames(self, start=0, stop=None):
+        # Seek to the first frame directly, then add one layer per frame. The canvas is updated
+        # in place, so consumers must copy anything they keep.
+        stop = self.frame_count if stop is None else min(stop, self.frame_count)
+        if start >= stop:
+            return
+        canvas = self.render_frame(start)
+        yield start, canvas
+        for frame_index in range(start + 1, stop):
+            self.draw_layer(canvas, frame_index)
+            yield frame_index, canvas
+
+    def iter_frames_reversed(self, block_size):
+        # Walk the animation backwards in blocks of block_size frames, seeking to the start of
+        # each block, so reversed output never needs the whole frame sequence in memory
+        block_end = self.frame_count
+        while block_end > self.resume_frame:
+            block_start = max(self.resume_frame, block_end - block_size)
+            block = [(frame_index, frame.copy()) for frame_index, frame in self.iter_frames(block_start, block_end)]
+            for frame_index, frame in reversed(block):
+                yield frame_index, frame
+            block_end = block_start
+
+    def iter_frame_changes(self, stop=None):
+        # How much each frame differs from the one before it (the first one from the source), as the
+        # mean absolute difference per channel value over the whole frame. Only the box of the layer
+        # a frame adds is compared, and layers come from the cache the frames will be rendered from.
+        stop = self.frame_count if stop is None else min(stop, self.frame_count)
+        canvas = self.render_frame(self.resume_frame - 1) if self.resume_frame else self.new_canvas()
+        channel_values = canvas.size[0] * canvas.size[1] * 4
+        for frame_index in range(self.resume_frame, stop):
+            yield frame_index, self.draw_layer(canvas, frame_index, measure_change=True) / channel_values
+
+# Memory assumed for the interpreter, numpy and PIL themselves when splitting a memory ceiling
+PROCESS_BASE_BYTES = 128 * 1024 * 1024
+
+# Tile edges tried for memory-bounded rendering, largest first
+TILE_SIZES = [1024, 512, 256, 128, 64]
+
+def plan_memory_budget(image_size, max_memory_mb):
+    # Split a memory ceiling between the full-size images a bounded render holds (the source, its
+    # premultiplied copy used for resizing, and the canvas), the buffers needed to draw one tile of
+    # a layer, and whole frames kept for encoding or reversing, of which there must be at least one
+    width, height = image_size
+    frame_bytes = width * height * 4
+    available = max_memory_mb * 1024 * 1024 - PROCESS_BASE_BYTES - 3 * frame_bytes
+    for tile_size in TILE_SIZES:
+        # The crop a rotated tile is sampled from, the tile and its compositing buffers, and the
+        # rows PIL's resize keeps between its horizontal and vertical passes
+        tile_bytes = 4 * (6 * tile_size * tile_size + 2 * tile_size * height)
+        if tile_bytes + frame_bytes <= available:
+            return {'tile_size': tile_size, 'frames_in_memory': (available - tile_bytes) // frame_bytes}
+
+    needed_mb = math.ceil((PROCESS_BASE_BYTES + 4 * frame_bytes + tile_bytes) / (1024 * 1024))
+    raise ValueError(f"A memory ceiling of {max_memory_mb} MB is too low for a {width}x{height} image; at least {needed_mb} MB is needed.")
+
+def get_nearest_indices(source_length, target_length):
+    # Source rows or columns PIL's nearest-neighbour resize picks, found by resizing an index strip
+    strip = Image.fromarray(np.arange(source_length, dtype=np.int32).reshape(1, -1), 'I')
+    return np.asarray(strip.resize((target_length, 1), Image.Resampling.NEAREST))[0]
+
+class DrosteTiledCompositor(DrosteCompositor):
+    # Memory-bounded compositor for very large sources. Instead of resizing and rotating a whole
+    # layer, every layer is drawn onto the canvas one tile at a time: each tile is resampled from the
+    # part of the source it covers and rotated with the matrix PIL's rotate would use, so besides the
+    # source and the canvas only one tile's buffers are allocated at a time. Frames match the untiled
+    # compositor except for resampling rounding where tiles meet.
+    def __init__(self, source_image, shrink_factor, max_iterations, resampling_method, rotation_angle, max_memory_mb):
+        super().__init__(source_image, shrink_factor, max_iterations, resampling_method, rotation_angle, layer_cache_bytes=0)
+        budget = plan_memory_budget(self.source_image.size, max_memory_mb)
+        self.tile_size = budget['tile_size']
+        # Reversed blocks are whole frames too, so they get half of the frames the ceiling allows
+        self.max_block_frames = max(1, budget['frames_in_memory'] // 2)
+
+        self.resize_source = self.source_image
+        if self.pil_resampling_method != Image.Resampling.NEAREST:
+            # Image.resize premultiplies alpha on a copy of the whole image on every call, which
+            # would defeat resizing a tile at a time, so the premultiplied source is kept instead
+            self.resize_source = self.source_image.convert('RGBa')
+            if self.source_image.getextrema()[3][0] == 255:
+                # Premultiplying leaves opaque pixels unchanged, so the canvas can start from the copy
+                self.source_image = None
+
+    def new_canvas(self):
+        if self.source_image is None:
+            return self.resize_source.convert('RGBA')
+        return self.source_image.copy()
+
+    def resize_layer_box(self, index, box):
+        # The part of the source-sized-to-the-layer that falls inside box
+        layer_width, layer_height = self.layers[index]['size']
+        source_width, source_height = self.resize_source.size
+        with profile_stage('resize', index):
+            if self.pil_resampling_method == Image.Resampling.NEAREST:
+                columns = get_nearest_indices(source_width, layer_width)[box[0]:box[2]]
+                rows = get_nearest_indices(source_height, layer_height)[box[1]:box[3]]
+                region = self.resize_source.crop((int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1))
+                return Image.fromarray(np.asarray(region)[np.ix_(rows - rows[0], columns - columns[0])], 'RGBA')
+
+            scale_x, scale_y = source_width / layer_width, source_height / layer_height
+            resized_box = self.resize_source.resize(
+                (box[2] - box[0], box[3] - box[1]), self.pil_resampling_method,
+                box=(box[0] * scale_x, box[1] * scale_y, box[2] * scale_x, box[3] * scale_y))
+            return resized_box.convert('RGBA')
+
+    def render_layer_tile(self, index, box):
+        # Render one box of a layer, in the coordinates of the rotated layer, without the rest of it
+        layer = self.layers[index]
+        layer_width, layer_height = layer['size']
+        rotation = layer['rotation']
+        left, top, right, bottom = box
+
+        # PIL rotates by multiples of 90 degrees with a transpose, and by anything else with an
+        # affine map from the rotated layer back to the resized one
+        if rotation == 0:
+            return self.resize_layer_box(index, box)
+        transposes = {
+            180: ((layer_width - right, layer_height - bottom, layer_width - left, layer_height - top), Image.Transpose.ROTATE_180),
+            90: ((layer_width - bottom, left, layer_width - top, right), Image.Transpose.ROTATE_90),
+            270: ((top, layer_height - right, bottom, layer_height - left), Image.Transpose.ROTATE_270),
+        }
+        if rotation in transposes:
+            source_box, transpose = transposes[rotation]
+            resized_tile = self.resize_layer_box(index, source_box)
+            with profile_stage('rotate', index):
+                return resized_tile.transpose(transpose)
+
+        (a, b, c, d, e, f), _ = get_layer_rotation_matrix(layer['size'], rotation)
+        corners = [(a * x + b * y + c, d * x + e * y + f) for x, y in ((left, top), (right, top), (left, bottom), (right, bottom))]
+        # One pixel of margin so nearest-neighbour sampling at the tile's edges stays inside the crop
+        source_box = (
+            max(0, math.floor(min(x for x, _ in corners)) - 1), max(0, math.floor(min(y for _, y in corners)) - 1),
+            min(layer_width, math.ceil(max(x for x, _ in corners)) + 1), min(layer_height, math.ceil(max(y for _, y in corners)) + 1),
+        )
+        if source_box[2] <= source_box[0] or source_box[3] <= source_box[1]:
+            return None
+        tile_matrix = (a, b, a * left + b * top + c - source_box[0], d, e, d * left + e * top + f - source_box[1])
+        resized_tile = self.resize_layer_box(index, source_box)
+        with profile_stage('rotate', index):
+            return resized_tile.transform(
+                (right - left, bottom - top), Image.Transform.AFFINE, tile_matrix, Image.Resampling.NEAREST, fillcolor=(0, 0, 0, 0))
+
+    def render_layer(self, index):
+        rotated_width, rotated_height = self.layers[index]['rotated_size']
+        layer_image = self.render_layer_tile(index, (0, 0, rotated_width, rotated_height))
+        if layer_image is None or self.is_layer_opaque(index):
+            return layer_image
+        return premask_droste_layer(layer_image)
+
+    def draw_layer(self, canvas, index, measure_change=False):
+        layer = self.layers[index]
+        offset_x, offset_y = layer['offset']
+        rotated_width, rotated_height = layer['rotated_size']
+        # Only the part of the layer that lands on the canvas is drawn
+        left, top = max(0, -offset_x), max(0, -offset_y)
+        right = min(rotated_width, canvas.size[0] - offset_x)
+        bottom = min(rotated_height, canvas.size[1] - offset_y)
+        opaque = self.is_layer_opaque(index)
+        change = 0
+        for tile_top in range(top, bottom, self.tile_size):
+            for tile_left in range(left, right, self.tile_size):
+                box = (tile_left, tile_top, min(right, tile_left + self.tile_size), min(bottom, tile_top + self.tile_size))
+                tile = self.render_layer_tile(index, box)
+                if tile is not None:
+                    with profile_stage('composite', index):
+                        if not opaque:
+                            tile = premask_droste_layer(tile)
+                        tile_change = composite_droste_layer(canvas, tile, (offset_x + tile_left, offset_y + tile_top), measure_change, opaque)
+                    if measure_change:
+                        change += tile_change
+        return change if measure_change else None
+
+    def iter_frames_reversed(self, block_size):
+        return super().iter_frames_reversed(max(1, min(block_size, self.max_block_frames)))
+
+# Resampling methods the inverse map samples with directly; the wider filters average a whole
+# neighbourhood of the source, so renders with them fall back to the composite engine
+INVERSE_MAP_RESAMPLING_METHODS = ['nearest', 'bilinear']
+
+class DrosteInverseMapRenderer(DrosteCompositor):
+    # Compositor that renders each nested layer by mapping its pixels back to the source instead of
+    # resizing the whole source and rotating the result. Every pixel of the rotated layer is sent
+    # through the matrix PIL's rotate would use and then through the layer's scale, and sampled once
+    # with a single affine transform, so a layer costs its own area rather than the source's and no
+    # resized intermediate is made. Bilinear samples come from the pyramid level just larger than the
+    # layer, which keeps deep layers from aliasing; nearest samples come from the source itself.
+    # Layers are cached, blended onto the canvas and shared with worker processes like the
+    # compositor's, so translucent sources blend the same way.
+    def __init__(self, source_image, shrink_factor, max_iterations, resampling_method, rotation_angle, layer_cache_bytes=LAYER_CACHE_BYTES, pyramid=False):
+        if resampling_method.lower() not in INVERSE_MAP_RESAMPLING_METHODS:
+            raise ValueError(f"The inverse map only samples with {' or '.join(INVERSE_MAP_RESAMPLING_METHODS)} resampling.")
+        super().__init__(source_image, shrink_factor, max_iterations, resampling_method, rotation_angle, layer_cache_bytes)
+        self.sample_levels = None
+
+    def get_sample_level(self, size):
+        # The smallest level at least as large as the layer. Levels halve the one before by averaging
+        # 2x2 blocks, premultiplied for a translucent source like resize averages it, and are built on
+        # first use. Nearest samples only pick pixels, so they always come from the source.
+        if self.pil_resampling_method == Image.Resampling.NEAREST:
+            return self.source_image
+        if self.sample_levels is None:
+            with profile_stage('pyramid'):
+                level = self.source_image if self.source_opaque else self.source_image.convert('RGBa')
+                self.sample_levels = [level]
+                while level.size[0] >= 2 and level.size[1] >= 2:
+                    level = level.reduce(2)
+                    self.sample_levels.append(level)
+        for level in reversed(self.sample_levels):
+            if level.size[0] >= size[0] and level.size[1] >= size[1]:
+                return level
+        return self.sample_levels[0]
+
+    def build_layer(self, index):
+        layer = self.layers[index]
+        level = self.get_sample_level(layer['size'])
+        # The matrix PIL's rotate would use, from the rotated layer back to the unrotated one,
+        # followed by the scale from the layer up to the level. PIL turns by multiples of 90 degrees
+        # with a transpose instead, so those layers are sampled unrotated and transposed the same way.
+        transposed = layer['rotation'] % 90 == 0
+        (a, b, c, d, e, f), _ = get_layer_rotation_matrix(layer['size'], 0 if transposed else layer['rotation'])
+        scale_x, scale_y = level.size[0] / layer['size'][0], level.size[1] / layer['size'][1]
+        matrix = (a * scale_x, b * scale_x, c * scale_x, d * scale_y, e * scale_y, f * scale_y)
+        with profile_stage('inverse_map', index):
+            rotated_image = level.transform(layer['size'] if transposed else layer['rotated_size'], Image.Transform.AFFINE, matrix,
+                                            self.pil_resampling_method, fillcolor=(0, 0, 0, 0))
+        if transposed and layer['rotation'] != 0:
+            with profile_stage('rotate', index):
+                rotated_image = rotated_image.rotate(layer['rotation'], expand=True)
+        if rotated_image.mode == 'RGBa':
+            rotated_image = rotated_image.convert('RGBA')
+        if not self.is_layer_opaque(index):
+            with profile_stage('composite', index):
+                rotated_image = premask_droste_layer(rotated_image)
+        return rotated_image
+
+# Per-process state of frame rendering workers, set up by init_droste_worker
+worker_state = {}
+
+def init_droste_worker(source_name, source_size, atlas_name, layer_offsets, shrink_factor, max_iterations, resampling_method, rotation_angle, pyramid=False, compositor_class=None, profiling=False):
+    # Attach to the shared source pixels instead of receiving a pickled copy
+    source_memory = shared_memory.SharedMemory(name=source_name)
+    atlas_memory = shared_memory.SharedMemory(name=atlas_name)
+    source_image = Image.frombuffer('RGBA', source_size, source_memory.buf, 'raw', 'RGBA', 0, 1)
+    worker_state['source_memory'] = source_memory
+    worker_state['atlas_memory'] = atlas_memory
+    worker_state['layer_offsets'] = layer_offsets
+    worker_state['profiling'] = profiling
+    # Every worker builds its own pyramid; the levels add a third of the source at most. Layers are
+    # rendered by the same kind of compositor as the frames they belong to.
+    worker_state['compositor'] = (compositor_class or DrosteCompositor)(source_image, shrink_factor, max_iterations, resampling_method, rotation_angle, layer_cache_bytes=0, pyramid=pyramid)
+
+def render_droste_layer_task(index):
+    # Render one nested layer straight into the shared layer atlas. When the run is profiled, the
+    # task times its stages in the worker and returns them for the parent's report.
+    profiler = start_profiling() if worker_state['profiling'] else None
+    compositor = worker_state['compositor']
+    layer_bytes = compositor.render_layer(index).tobytes()
+    offset = worker_state['layer_offsets'][index]
+    worker_state['atlas_memory'].buf[offset:offset + len(layer_bytes)] = layer_bytes
+    if profiler is None:
+        return None
+    stop_profiling()
+    return profiler.get_timings()
+
+class DrosteFramePool:
+    # Renders frames across worker processes. Resizing and rotating the nested layer is the
+    # expensive part of every frame, so each frame's layer is rendered by a worker straight into a
+    # shared layer atlas; the source image is shared the same way, so tasks only carry a layer index.
+    # Finished layers are composited in frame order, which is cheap as it only touches each layer's
+    # bounding box.
+    def __init__(self, compositor, workers):
+        self.compositor = compositor
+        self.workers = workers
+        self.executor = None
+        self.source_memory = None
+        self.atlas_memory = None
+        self.layer_futures = {}
+        self.layer_offsets = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def start(self):
+        source_image = self.compositor.source_image
+        source_bytes = source_image.tobytes()
+        self.source_memory = shared_memory.SharedMemory(create=True, size=max(1, len(source_bytes)))
+        self.source_memory.buf[:len(source_bytes)] = source_bytes
+
+        atlas_size = 0
+        for layer in self.compositor.layers:
+            self.layer_offsets.append(atlas_size)
+            atlas_size += layer['rotated_size'][0] * layer['rotated_size'][1] * 4
+        self.atlas_memory = shared_memory.SharedMemory(create=True, size=max(1, atlas_size))
+
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=init_droste_worker,
+            initargs=(self.source_memory.name, source_image.size, self.atlas_memory.name, self.layer_offsets,
+                      self.compositor.shrink_factor, self.compositor.max_iterations,
+                      self.compositor.resampling_method, self.compositor.rotation_angle, self.compositor.pyramid,
+                      type(self.compositor), is_profiling()))
+        # Submitted in frame order, so the largest layers are started first
+        # Layers of frames an earlier run already rendered are never needed
+        self.layer_futures = {index: self.executor.submit(render_droste_layer_task, index)
+                              for index in range(self.compositor.resume_frame, self.compositor.frame_count)}
+
+    def wait_for_layer(self, index):
+        if index not in self.compositor.prepared_layers:
+            with profile_stage('layer_wait', index):
+                timings = self.layer_futures[index].result()
+            merge_profile_timings(timings)
+            offset = self.layer_offsets[index]
+            rotated_size = self.compositor.layers[index]['rotated_size']
+            layer_buffer = self.atlas_memory.buf[offset:offset + rotated_size[0] * rotated_size[1] * 4]
+            self.compositor.prepared_layers[index] = Image.frombuffer('RGBA', rotated_size, layer_buffer, 'raw', 'RGBA', 0, 1)
+
+    def iter_frames(self, reverse=False, reverse_block_size=8):
+        first_frame = self.compositor.resume_frame
+        if reverse:
+            for index in range(first_frame, self.compositor.frame_count):
+                self.wait_for_layer(index)
+            yield from self.compositor.iter_frames_reversed(reverse_block_size)
+            return
+
+        canvas = self.compositor.resume_canvas.copy() if first_frame else self.compositor.source_image.copy()
+        for index in range(first_frame, self.compositor.frame_count):
+            # Layers can finish out of order; frames are only released in order
+            self.wait_for_layer(index)
+            self.compositor.draw_layer(canvas, index)
+            yield index, canvas
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+        # Drop the views into the atlas before releasing it
+        self.compositor.prepared_layers.clear()
+        for memory in (self.source_memory, self.atlas_memory):
+            if memory is not None:
+                memory.close()
+                memory.unlink()
+        self.source_memory = None
+        self.atlas_memory = None
+
+# Minimum number of seconds between two "Processing iteration" messages
+PROGRESS_INTERVAL = 0.25
+
+# Called with the iteration and the frame count for every frame rendered, when something other
+# than the console follows the progress of a render (the render service's workers)
+progress_callback = None
+
+def set_progress_callback(callback):
+    global progress_callback
+    progress_callback = callback
+
+# Frame rendering engines selectable from create_droste_image_effect
+DROSTE_ENGINES = {
+    'composite': DrosteCompositor,
+    'inverse_map': DrosteInverseMapRenderer,
+}
+
+# What happens to frames identical to the frame before them
+DUPLICATE_FRAME_MODES = ['keep', 'drop', 'retime']
+
+# Animated outputs written next to the videos, with their file extensions
+ANIMATION_FORMATS = {
+    'none': None,
+    'webp': 'webp',
+    'apng': 'png',
+    'gif': 'gif',
+}
+
+def load_droste_renderer(image_path, shrink_factor, max_iterations, resampling_method, rotation_angle, engine='composite', max_memory_mb=None, min_layer_size=1, change_epsilon=0.0, drop_duplicates=False, pyramid=False, resume_state=None):
+    # resume_state is the frame index and composite an earlier run stopped at (see droste_checkpoint)
+    if max_memory_mb:
+        with Image.open(image_path) as source_file:
+            # Check the ceiling against the image header before decoding anything
+            plan_memory_budget(source_file.size, max_memory_mb)
+            with profile_stage('decode'):
+                original_image = source_file.convert('RGBA')
+    else:
+        # Load the original image
+        with profile_stage('decode'):
+            original_image = Image.open(image_path).convert('RGBA')
+    return build_droste_renderer(original_image, shrink_factor, max_iterations, resampling_method, rotation_angle, engine, max_memory_mb,
+                                 min_layer_size, change_epsilon, drop_duplicates, pyramid, resume_state)
+
+def build_droste_renderer(original_image, shrink_factor, max_iterations, resampling_method, rotation_angle, engine='composite', max_memory_mb=None, min_layer_size=1, change_epsilon=0.0, drop_duplicates=False, pyramid=False, resume_state=None):
+    # Renderer for a source that is already decoded to RGBA, so variants of one image can share it
+    if engine == 'inverse_map' and resampling_method.lower() not in INVERSE_MAP_RESAMPLING_METHODS:
+        print(f"The inverse map cannot sample with {resampling_method} resampling; rendering with the composite engine.")
+        engine = 'composite'
+    if max_memory_mb:
+        renderer = DrosteTiledCompositor(original_image, shrink_factor, max_iterations, resampling_method, rotation_angle, max_memory_mb)
+    elif pyramid and engine == 'composite':
+        renderer = DrosteCompositor(original_image, shrink_factor, max_iterations, resampling_method, rotation_angle, pyramid=True)
+    else:
+        renderer = DROSTE_ENGINES[engine](original_image, shrink_factor, max_iterations, resampling_method, rotation_angle)
+    if resume_state is not None:
+        renderer.resume_from(*resume_state)
+    limit_droste_frames(renderer, min_layer_size, change_epsilon, drop_duplicates)
+    return renderer
+
+def limit_droste_frames(renderer, min_layer_size=1, change_epsilon=0.0, drop_duplicates=False):
+    # Stop the animation once deeper layers no longer make a visible difference: at the first layer
+    # narrower or shorter than min_layer_size pixels, or at the first frame that differs from the one
+    # before it by less than change_epsilon (mean absolute difference per channel value). The first
+    # frame is always kept. With drop_duplicates, frames identical to the one before them are marked
+    # as skipped. Changes are measured in a pass of its own, before any frame is rendered, so the
+    # frame count is known up front for reversed passes and worker pools. Frames an earlier run
+    # already rendered are kept as they are.
+    frame_count = renderer.frame_count
+    for index in range(max(1, renderer.resume_frame), frame_count):
+        if min(renderer.layers[index]['size']) < min_layer_size:
+            frame_count = index
+            break
+
+    if change_epsilon > 0 or drop_duplicates:
+        with profile_stage('measure'):
+            for index, change in renderer.iter_frame_changes(frame_count):
+                if index == 0:
+                    continue
+                if change < change_epsilon:
+                    frame_count = index
+                    break
+                if drop_duplicates and change == 0:
+                    renderer.skipped_frames.add(index)
+
+    if frame_count < renderer.frame_count:
+        print(f"Stopping after {frame_count} iterations: deeper layers make no visible difference.")
+        renderer.layers = renderer.layers[:frame_count]
+        renderer.frame_count = frame_count
+        renderer.stopped_early = True
+    if renderer.skipped_frames:
+        print(f"Dropping {len(renderer.skipped_frames)} duplicate frames.")
+
+def open_droste_frame_pool(renderer, workers):
+    # Only the compositing engine has per-frame layers worth spreading over worker processes, and
+    # sharing every layer in full is not an option under a memory ceiling
+    if workers > 1 and isinstance(renderer, DrosteCompositor) and not isinstance(renderer, DrosteTiledCompositor):
+        return DrosteFramePool(renderer, workers)
+    return nullcontext()
+
+def generate_droste_frames(image_path, shrink_factor, max_iterations, resampling_method, rotation_angle, renderer=None, frame_pool=None):
+    if renderer is None:
+        renderer = load_droste_renderer(image_path, shrink_factor, max_iterations, resampling_method, rotation_angle)
+
+    frames = frame_pool.iter_frames() if frame_pool is not None else renderer.iter_frames(renderer.resume_frame)
+    last_progress_time = None
+    last_printed = iteration = None
+    for iteration, frame in frames:
+        # Printing every iteration of a long run costs more than the small layers do, so progress
+        # is printed at most a few times per second (and for the last iteration below)
+        now = time.perf_counter()
+        if last_progress_time is None or now - last_progress_time >= PROGRESS_INTERVAL:
+            print(f"Processing iteration {iteration}...")
+            last_progress_time = now
+            last_printed = iteration
+        if progress_callback is not None:
+            progress_callback(iteration, renderer.frame_count)
+        if iteration in renderer.skipped_frames:
+            continue
+        profile_frame()
+        # The composite may be updated in place, so consumers must copy anything they keep
+        yield iteration, frame
+    if iteration is not None and iteration != last_printed:
+        print(f"Processing iteration {iteration}...")
+
+    if renderer.frame_count < max_iterations and not renderer.stopped_early:
+        print("Terminating process: Image has become too small to process any further.")
+
+def process_image_for_droste_effect(image_path, temp_dir, shrink_factor, max_iterations, resampling_method, rotation_angle, workers=1, engine='composite', max_memory_mb=None, min_layer_size=1, change_epsilon=0.0, drop_duplicates=False, render_info=None, pyramid=False, animation_writer=None):
+    frame_paths = []
+    frame_format = 'bmp'
+    final_image = None
+    try:
+        renderer = load_droste_renderer(image_path, shrink_factor, max_iterations, resampling_method, rotation_angle, engine, max_memory_mb,
+                                        min_layer_size, change_epsilon, drop_duplicates, pyramid)
+        if render_info is not None:
+            # Frames skipped as duplicates leave no file, so callers that re-time them need the full count
+            render_info['frame_count'] = renderer.frame_count
+            render_info['skipped_frames'] = renderer.skipped_frames
+        with open_droste_frame_pool(renderer, workers) as frame_pool:
+            frames = generate_droste_frames(image_path, shrink_factor, max_iterations, resampling_method, rotation_angle, renderer, frame_pool)
+            if animation_writer is not None:
+                # The animation is written as the frames are rendered, instead of from the saved frames
+                from droste_animation import write_droste_animation
+                frames = write_droste_animation(frames, animation_writer, renderer.frame_count)
+            for iteration, frame in frames:
+                # Save the frame
+                frame_path = os.path.join(temp_dir, f"frame_{iteration}.{frame_format}")
+                with profile_stage('frame_save', iteration):
+                    saved = save_image_with_format(frame, frame_path, frame_format)
+                if not saved:
+                    print(f"Failed to save frame {iteration}.")
+                    return [], None
+                profile_file('frames', frame_path)
+                frame_paths.append(frame_path)
+                final_image = frame
+
+        return frame_paths, final_image
+    except Exception as e:
+        print(f"Error in processing image for Droste effect: {e}")
+        traceback.print_exc()
+        return [], None
+
+def create_droste_image_effect(image_path, output_path, shrink_factor, max_iterations, save_timelapse, fps, include_reverse, timelapse_video_path, reversed_clip_path, save_reversed, resampling_method, rotation_angle, output_format, stream_frames=False, max_frames_in_flight=8, workers=1, engine='composite', cache_dir=None, cache_size_mb=None, max_memory_mb=None, min_layer_size=1, change_epsilon=0.0, duplicate_frames='keep', pyramid=False, encoder_settings=None, animation_format='none', resume=False):
+    start_time = time.time()
+    animation_path = build_animation_path(output_path, animation_format)
+    if max_memory_mb:
+        try:
+            with Image.open(image_path) as source_file:
+                budget = plan_memory_budget(source_file.size, max_memory_mb)
+        except (ValueError, OSError) as e:
+            print(f"An error occurred during image processing: {e}")
+            return False
+        # Every queue between rendering and encoding holds whole frames, which count against the ceiling
+        max_frames_in_flight = max(1, min(max_frames_in_flight, budget['frames_in_memory'] // 6))
+
+    if resume:
+        # A checkpoint takes the place of the render cache: it extends a render instead of repeating it
+        from droste_checkpoint import create_resumed_droste_image_effect
+        try:
+            return create_resumed_droste_image_effect(
+                image_path, output_path, shrink_factor, max_iterations, save_timelapse, fps, include_reverse,
+                timelapse_video_path, reversed_clip_path, save_reversed, resampling_method, rotation_angle,
+                output_format, max_frames_in_flight, workers, engine, max_memory_mb, min_layer_size, change_epsilon,
+                duplicate_frames, pyramid, encoder_settings)
+        finally:
+            end_time = time.time()
+            print(f"Total time for creating Droste effect: {end_time - start_time:.2f} seconds.")
+            print_peak_memory()
+
+    render_cache = None
+    cache_key = None
+    if cache_dir:
+        # Repeated renders of the same source and parameters are served from the render cache
+        from droste_cache import DEFAULT_CACHE_SIZE_MB, DrosteRenderCache
+        try:
+            render_cache = DrosteRenderCache(cache_dir, (cache_size_mb or DEFAULT_CACHE_SIZE_MB) * 1024 * 1024)
+            cache_key = render_cache.make_key(image_path, shrink_factor, max_iterations, resampling_method, rotation_angle, engine, max_memory_mb,
+                                              min_layer_size, change_epsilon, duplicate_frames, pyramid)
+            if render_cache.restore(cache_key, output_path, output_format, fps, include_reverse, timelapse_video_path if save_timelapse else None, reversed_clip_path, save_reversed,
+                                    duplicate_frames, encoder_settings, animation_format, animation_path, max_memory_mb):
+                print("Image processing complete.")
+                print_chosen_parameters(shrink_factor, max_iterations, save_timelapse, fps, include_reverse, save_reversed, resampling_method, rotation_angle)
+                end_time = time.time()
+                print(f"Total time for creating Droste effect: {end_time - start_time:.2f} seconds.")
+                print_peak_memory()
+                return True
+        except OSError as e:
+            print(f"Render cache unavailable, rendering without it: {e}")
+            render_cache = None
+
+    if stream_frames:
+        try:
+            return create_streamed_droste_image_effect(
+                image_path, output_path, shrink_factor, max_iterations, save_timelapse, fps, include_reverse,
+                timelapse_video_path, reversed_clip_path, save_reversed, resampling_method, rotation_angle,
+                output_format, max_frames_in_flight, workers, engine, render_cache, cache_key, max_memory_mb,
+                min_layer_size, change_epsilon, duplicate_frames, pyramid, encoder_settings, animation_format, animation_path)
+        finally:
+            end_time = time.time()
+            print(f"Total time for creating Droste effect: {end_time - start_time:.2f} seconds.")
+            print_peak_memory()
+
+    temp_dir = tempfile.mkdtemp()
+    animation_writer = None
+    try:
+        if animation_path:
+            from droste_animation import open_animation_writer
+            animation_writer = open_animation_writer(animation_format, animation_path, fps, duplicate_frames == 'drop')
+        render_info = {}
+        frame_paths, final_image = process_image_for_droste_effect(
+            image_path, temp_dir, shrink_factor, max_iterations, resampling_method, rotation_angle, workers, engine, max_memory_mb,
+            min_layer_size, change_epsilon, duplicate_frames != 'keep', render_info, pyramid, animation_writer)
+
+        if not frame_paths or final_image is None:
+            return False
+
+        with profile_stage('final_save'):
+            saved = save_image_with_format(final_image, output_path, output_format)
+        if not saved:
+            print("Failed to save the final image.")
+            return False
+        profile_file('final_image', output_path)
+
+        print("Image processing complete.")
+
+        # Create the time-lapse video and/or reversed clip if required
+        if save_timelapse or save_reversed:
+            from droste_video import create_videos
+            success = create_videos(frame_paths, timelapse_video_path if save_timelapse else None, reversed_clip_path, fps, include_reverse, save_reversed, max_frames_in_flight,
+                                    (render_info['frame_count'], render_info['skipped_frames']) if duplicate_frames == 'retime' else None, encoder_settings,
+                                    max_memory_mb)
+            if not success:
+                print("Failed to create videos.")
+                return False
+
+        if render_cache is not None:
+            render_cache.store(cache_key, final_image, frame_paths=frame_paths, videos=[(path, passes, fps) for path, passes in plan_video_outputs(
+                timelapse_video_path if save_timelapse else None, reversed_clip_path, include_reverse, save_reversed)], encoder_settings=encoder_settings)
+
+        # Display the chosen parameters
+        print_chosen_parameters(shrink_factor, max_iterations, save_timelapse, fps, include_reverse, save_reversed, resampling_method, rotation_angle)
+        return True
+
+    except Exception as e:
+        print(f"An error occurred during image processing: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        cleanup_temp_dir(temp_dir)
+        if animation_writer is not None:
+            animation_writer.discard()
+        
+        end_time = time.time()
+        print(f"Total time for creating Droste effect: {end_time - start_time:.2f} seconds.")
+        print_peak_memory()
+
+def create_streamed_droste_image_effect(image_path, output_path, shrink_factor, max_iterations, save_timelapse, fps, include_reverse, timelapse_video_path, reversed_clip_path, save_reversed, resampling_method, rotation_angle, output_format, max_frames_in_flight, workers=1, engine='composite', render_cache=None, cache_key=None, max_memory_mb=None, min_layer_size=1, change_epsilon=0.0, duplicate_frames='keep', pyramid=False, encoder_settings=None, animation_format='none', animation_path=None):
+    # Same outputs as the frame-file pipeline, but frames never leave memory
+    # (unless they are kept in the render cache, which needs the forward pass of a time-lapse)
+    cache_frame_dir = render_cache.new_frame_dir() if render_cache is not None and save_timelapse else None
+    animation_writer = None
+    final_image = None
+    try:
+        if animation_path:
+            from droste_animation import open_animation_writer, write_droste_animation
+            animation_writer = open_animation_writer(animation_format, animation_path, fps, duplicate_frames == 'drop')
+        if save_timelapse or save_reversed:
+            # The animation is written from the time-lapse's forward pass
+            from droste_video import stream_droste_effect_to_videos
+            final_image = stream_droste_effect_to_videos(
+                image_path, timelapse_video_path if save_timelapse else None, reversed_clip_path, fps,
+                include_reverse, save_reversed, shrink_factor, max_iterations, resampling_method,
+                rotation_angle, max_frames_in_flight, workers, engine, cache_frame_dir, max_memory_mb,
+                min_layer_size, change_epsilon, duplicate_frames, pyramid, encoder_settings,
+                animation_writer if save_timelapse else None)
+        if animation_writer is not None and not save_timelapse:
+            # Without a time-lapse there is no forward pass, so the frames are rendered for the animation alone
+            renderer = load_droste_renderer(image_path, shrink_factor, max_iterations, resampling_method, rotation_angle, engine, max_memory_mb,
+                                            min_layer_size, change_epsilon, duplicate_frames != 'keep', pyramid)
+            with open_droste_frame_pool(renderer, workers) as frame_pool:
+                frames = generate_droste_frames(image_path, shrink_factor, max_iterations, resampling_method, rotation_angle, renderer, frame_pool)
+                for _, frame in write_droste_animation(frames, animation_writer, renderer.frame_count):
+                    if not save_reversed:
+                        final_image = frame
+        elif not (save_timelapse or save_reversed):
+            # Without videos only the last frame is needed, and it can be rendered directly
+            renderer = load_droste_renderer(image_path, shrink_factor, max_iterations, resampling_method, rotation_angle, engine, max_memory_mb,
+                                            min_layer_size, change_epsilon, pyramid=pyramid)
+            final_image = renderer.render_frame(renderer.frame_count - 1) if renderer.frame_count else None
+
+        if final_image is None:
+            return False
+
+        with profile_stage('final_save'):
+            saved = save_image_with_format(final_image, output_path, output_format)
+        if not saved:
+            print("Failed to save the final image.")
+            return False
+        profile_file('final_image', output_path)
+
+        print("Image processing complete.")
+        if render_cache is not None:
+            render_cache.store(cache_key, final_image, frame_dir=cache_frame_dir, videos=[(path, passes, fps) for path, passes in plan_video_outputs(
+                timelapse_video_path if save_timelapse else None, reversed_clip_path, include_reverse, save_reversed)], encoder_settings=encoder_settings)
+            cache_frame_dir = None
+        print_chosen_parameters(shrink_factor, max_iterations, save_timelapse, fps, include_reverse, save_reversed, resampling_method, rotation_angle)
+        return True
+    except Exception as e:
+        print(f"An error occurred during image processing: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        if cache_frame_dir is not None:
+            cleanup_temp_dir(cache_frame_dir)
+        if animation_writer is not None:
+            animation_writer.discard()
+
+def build_animation_path(output_image_path, animation_format):
+    # The animation sits next to the final image, named like the videos
+    extension = ANIMATION_FORMATS.get(animation_format)
+    if not extension:
+        return None
+    return f"{os.path.splitext(output_image_path)[0]}_animation.{extension}"
+
+def validate_animation_format(animation_format):
+    animation_format = str(animation_format).lower()
+    if animation_format not in ANIMATION_FORMATS:
+        raise ValueError(f"Invalid animation format. Choose from {', '.join(ANIMATION_FORMATS)}.")
+    if animation_format == 'webp':
+        from PIL import features
+        if not features.check('webp_anim'):
+            raise ValueError("Animated WebP needs a Pillow built with WebP animation support.")
+    return animation_format
+
+def plan_video_outputs(timelapse_video_path, reversed_clip_path, include_reverse, save_reversed):
+    # Each requested video is listed once, together with the frame passes it is built from
+    outputs = []
+    if timelapse_video_path:
+        outputs.append((timelapse_video_path, ['forward', 'reverse'] if include_reverse else ['forward']))
+    if save_reversed and reversed_clip_path:
+        outputs.append((reversed_clip_path, ['reverse']))
+    return outputs
+
+def get_peak_memory_mb():
+    # Peak resident memory of this process and of the largest child process it waited for (render
+    # workers and ffmpeg encoders), in megabytes, or None where the platform does not report it
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit
+    return own, children
+
+def print_peak_memory():
+    peak_memory = get_peak_memory_mb()
+    if peak_memory is None:
+        return
+    own, children = peak_memory
+    if children:
+        print(f"Peak memory usage: {own:.1f} MB (largest child process: {children:.1f} MB)")
+    else:
+        print(f"Peak memory usage: {own:.1f} MB")
+
+def print_chosen_parameters(shrink_factor, max_iterations, save_timelapse, fps, include_reverse, save_reversed, resampling_method, rotation_angle):
+    print("\nChosen Parameters:")
+    print(f"Shrink Factor: {shrink_factor}")
+    print(f"Max Iterations: {max_iterations}")
+    print(f"Save Timelapse: {save_timelapse}")
+    if save_timelapse:
+        print(f"FPS for Timelapse: {fps}")
+        print(f"Include Reverse: {include_reverse}")
+        print(f"Save Reversed Clip: {save_reversed}")
+    print(f"Image Resampling Method: {resampling_method}")
+    print(f"Rotation Angle: {rotation_angle}")
+
+def save_image_with_format(image, path, format):
+    try:
+        # Check if the format is JPEG or JPG and the image mode is RGBA
+        if format in ['jpeg', 'jpg'] and image.mode == 'RGBA':
+            image = image.convert('RGB')
+        # Save with high quality for JPEG
+        if format in ['jpeg', 'jpg']:
+            image.save(path, quality=100)
+        else:
+            # Save in the current mode for other formats
+            image.save(path)
+        return True
+    except Exception as e:
+        print(f"An error occurred while saving the image: {e}")
+        traceback.print_exc()
+        return False
+
+def validate_parameters(image_path, shrink_factor_str, max_iterations_str, save_timelapse_str, fps_str, include_reverse_str, save_reversed_str, resampling_method, rotation_angle_str, output_format, output_path, is_output_format_provided):
+    # Helper function to parse boolean strings
+    def parse_bool(value):
+        if value.lower() not in ['yes', 'no', 'true', 'false']:
+            raise ValueError(f"Invalid input for boolean value. Please enter 'yes', 'no', 'true', or 'false'. Received: {value}")
+        return value.lower() in ['yes', 'true']
+
+    # Check for None values in required parameters
+    required_params = {
+        'shrink_factor': shrink_factor_str, 
+        'max_iterations': max_iterations_str, 
+        'resampling_method': resampling_method, 
+        'rotation_angle': rotation_angle_str, 
+        'output_format': output_format
+    }
+    for param_name, param_value in required_params.items():
+        if param_value is None:
+            raise ValueError(f"{param_name} is a required parameter and cannot be None.")
+
+    # Image Path Validation
+    if not os.path.isfile(image_path):
+        raise ValueError(f"The specified image path does not exist or is not a file: {image_path}")
+    _, image_ext = os.path.splitext(image_path)
+    if image_ext.lower() not in VALID_IMAGE_EXTENSIONS:
+        raise ValueError(f"The file extension of the image is not supported. Supported extensions are: {', '.join(VALID_IMAGE_EXTENSIONS)}.")
+
+    # Shrink Factor Validation
+    shrink_factor = parse_float(shrink_factor_str, "Shrink factor")
+    if not (0 < shrink_factor <= 0.99):
+        raise ValueError("Shrink factor must be between 0.01 and 0.99")
+
+    # Max Iterations Validation
+    max_iterations = parse_int(max_iterations_str, "Max iterations")
+    if max_iterations <= 0:
+        raise ValueError("Max iterations must be a positive integer")
+
+    # Timelapse, FPS, Include Reverse, and Save Reversed Validation
+    save_timelapse = parse_bool(save_timelapse_str)
+    include_reverse = parse_bool(include_reverse_str)
+    save_reversed = parse_bool(save_reversed_str)
+
+    if save_timelapse:
+        fps = parse_int(fps_str, "FPS")
+        if fps <= 0:
+            raise ValueError("FPS must be a positive integer.")
+    else:
+        fps = 10
+
+    if not save_timelapse and (include_reverse or save_reversed):
+        raise ValueError("Cannot include reverse or save reversed clip in video without saving timelapse.")
+
+    # Resampling Method Validation
+    valid_resampling_methods = ['nearest', 'box', 'bilinear', 'hamming', 'bicubic', 'lanczos']
+    if resampling_method.lower() not in valid_resampling_methods:
+        raise ValueError(f"Invalid resampling method. Choose from {', '.join(valid_resampling_methods)}.")
+
+    # Rotation Angle Validation
+    rotation_angle = parse_float(rotation_angle_str, "Rotation angle")
+    if not (-360 <= rotation_angle <= 360):
+        raise ValueError("Rotation angle must be between -360 and 360 degrees")
+
+    # Output Format Validation
+    valid_formats = ['png', 'jpg', 'jpeg', 'bmp', 'webp']
+    if output_format.lower() not in valid_formats:
+        raise ValueError(f"Invalid output format. Choose from {', '.join(valid_formats)}.")
+
+    # Output Path Validation
+    if output_path and not os.path.isdir(output_path):
+        raise ValueError(f"The specified output path is not a directory: {output_path}")
+
+    return {
+        'shrink_factor': shrink_factor,
+        'max_iterations': max_iterations,
+        'save_timelapse': save_timelapse,
+        'fps': fps,
+        'include_reverse': include_reverse,
+        'save_reversed': save_reversed,
+        'resampling_method': resampling_method.lower(),
+        'rotation_angle': rotation_angle,
+        'output_format': output_format
+    }
+
+def build_output_paths(image_path, output_path, output_format, save_timelapse, save_reversed, output_name=None):
+    # Outputs are named after the image unless output_name is given
+    base_filename = output_name or os.path.splitext(os.path.basename(image_path))[0]
+    # Handle the output directory
+    if output_path:
+        if not os.path.isdir(output_path):
+            raise ValueError(f"The specified output path is not a directory: {output_path}")
+        output_base_path = os.path.join(output_path, base_filename)
+    else:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        output_base_path = os.path.join(os.getcwd(), f"{base_filename}_{timestamp}")
+
+    output_image_path = f"{output_base_path}.{output_format}"
+    timelapse_video_path = f"{output_base_path}_timelapse.mp4" if save_timelapse else None
+    reversed_clip_path = f"{output_base_path}_reversed.mp4" if save_reversed else None
+    return output_image_path, timelapse_video_path, reversed_clip_path
+
+# Helper functions for parsing float and int values
+def parse_float(value_str, param_name):
+    try:
+        return float(value_str)
+    except ValueError:
+        raise ValueError(f"{param_name} must be a valid floating-point number.")
+
+def parse_int(value_str, param_name):
+    try:
+        return int(value_str)
+    except ValueError:
+        raise ValueError(f"{param_name} must be a valid integer.")
@@ -0,0 +1,168 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import numpy as np
+from droste_core import parse_int
+
+# Video codecs the encoder backends can produce, with the ffmpeg encoder behind each one and the
+# constant rate factor it uses unless told otherwise. CRF runs 0-51 for x264/x265 and 0-63 for
+# VP9/AV1; lower is better quality and bigger files.
+VIDEO_CODECS = {
+    'x264': {'encoder': 'libx264', 'default_crf': 23, 'max_crf': 51},
+    'x265': {'encoder': 'libx265', 'default_crf': 28, 'max_crf': 51},
+    'vp9': {'encoder': 'libvpx-vp9', 'default_crf': 31, 'max_crf': 63},
+    'av1': {'encoder': 'libaom-av1', 'default_crf': 30, 'max_crf': 63},
+}
+
+# x264-style presets, fastest first; VP9 and AV1 map them onto their cpu-used speed levels
+ENCODER_PRESETS = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow']
+
+PIXEL_FORMATS = ['yuv420p', 'yuv422p', 'yuv444p']
+
+DEFAULT_ENCODER_SETTINGS = {
+    'backend': 'ffmpeg',
+    'codec': 'x264',
+    'preset': 'medium',
+    'crf': 23,
+    'threads': 0,
+    'pix_fmt': 'yuv420p',
+}
+
+def get_ffmpeg_binary():
+    # The same ffmpeg MoviePy is configured with, which is imageio's bundled binary by default
+    from moviepy.config import get_setting
+    return get_setting("FFMPEG_BINARY")
+
+def build_encoder_settings(backend='ffmpeg', codec='x264', preset='medium', crf=None, threads=0, pix_fmt='yuv420p'):
+    # Validated settings for open_video_encoder; crf None picks the codec's default
+    if backend not in VIDEO_ENCODER_BACKENDS:
+        raise ValueError(f"Invalid video encoder. Choose from {', '.join(VIDEO_ENCODER_BACKENDS)}.")
+    codec = str(codec).lower()
+    if codec not in VIDEO_CODECS:
+        raise ValueError(f"Invalid codec. Choose from {', '.join(VIDEO_CODECS)}.")
+    preset = str(preset).lower()
+    if preset not in ENCODER_PRESETS:
+        raise ValueError(f"Invalid preset. Choose from {', '.join(ENCODER_PRESETS)}.")
+    if crf is None or crf == '':
+        crf = VIDEO_CODECS[codec]['default_crf']
+    crf = parse_int(str(crf), "CRF")
+    if not 0 <= crf <= VIDEO_CODECS[codec]['max_crf']:
+        raise ValueError(f"CRF for {codec} must be between 0 and {VIDEO_CODECS[codec]['max_crf']}.")
+    threads = parse_int(str(threads), "Encoder threads")
+    if threads < 0:
+        raise ValueError("Encoder threads must be zero or a positive integer.")
+    pix_fmt = str(pix_fmt).lower()
+    if pix_fmt not in PIXEL_FORMATS:
+        raise ValueError(f"Invalid pixel format. Choose from {', '.join(PIXEL_FORMATS)}.")
+    if backend == 'moviepy' and (codec != 'x264' or pix_fmt != 'yuv420p'):
+        raise ValueError("The moviepy encoder only supports the x264 codec with the yuv420p pixel format.")
+    return {'backend': backend, 'codec': codec, 'preset': preset, 'crf': crf, 'threads': threads, 'pix_fmt': pix_fmt}
+
+def describe_encoder_settings(encoder_settings):
+    # Short tag that tells videos encoded with different settings apart; empty for the defaults,
+    # so videos made before there was a choice keep their names
+    if not encoder_settings or encoder_settings == DEFAULT_ENCODER_SETTINGS:
+        return ''
+    settings = dict(DEFAULT_ENCODER_SETTINGS, **encoder_settings)
+    return f"{settings['codec']}-{settings['preset']}-crf{settings['crf']}-t{settings['threads']}-{settings['pix_fmt']}-{settings['backend']}"
+
+def build_codec_params(encoder_settings, size, threads):
+    settings = dict(DEFAULT_ENCODER_SETTINGS, **(encoder_settings or {}))
+    codec = settings['codec']
+    params = ['-vcodec', VIDEO_CODECS[codec]['encoder']]
+    speed = len(ENCODER_PRESETS) - 1 - ENCODER_PRESETS.index(settings['preset'])
+    if codec in ('x264', 'x265'):
+        params += ['-preset', settings['preset'], '-crf', str(settings['crf'])]
+    elif codec == 'vp9':
+        # libvpx only goes past cpu-used 5 in realtime mode
+        params += ['-deadline', 'realtime' if speed > 5 else 'good', '-cpu-used', str(speed), '-row-mt', '1',
+                   '-crf', str(settings['crf']), '-b:v', '0']
+    else:
+        params += ['-cpu-used', str(speed), '-row-mt', '1', '-crf', str(settings['crf']), '-b:v', '0']
+    if codec == 'x265':
+        # Lets Apple players recognise HEVC in MP4; x265 logs to stderr whatever ffmpeg's log level is
+        params += ['-tag:v', 'hvc1', '-x265-params', 'log-level=error']
+    pix_fmt = settings['pix_fmt']
+    if size[0] % 2 or size[1] % 2:
+        # Chroma subsampling needs even dimensions, so odd-sized frames keep full-resolution chroma
+        pix_fmt = 'yuv444p'
+    params += ['-threads', str(threads), '-pix_fmt', pix_fmt]
+    return params
+
+class FFmpegPipeEncoder:
+    # Pipes raw RGB frames straight into an ffmpeg subprocess
+    def __init__(self, output_path, size, fps, encoder_settings, threads, extra_params=()):
+        self.output_path = output_path
+        command = [
+            get_ffmpeg_binary(), '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-vcodec', 'rawvideo', '-s', f"{size[0]}x{size[1]}", '-pix_fmt', 'rgb24',
+            '-r', f"{fps:.02f}", '-an', '-i', '-',
+        ] + build_codec_params(encoder_settings, size, threads) + list(extra_params) + [output_path]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def write_frame(self, frame):
+        try:
+            # Frames go through as they are, without the copy tobytes() would make
+            self.process.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8))
+        except (BrokenPipeError, OSError):
+            # ffmpeg has stopped; closing reports why
+            self.close()
+            raise
+
+    def close(self):
+        if self.process.stdin.closed:
+            return
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        error = self.process.stderr.read().decode('utf-8', 'replace').strip()
+        self.process.stderr.close()
+        if self.process.wait() != 0:
+            raise IOError(f"ffmpeg failed to encode {self.output_path}: {error or f'exit status {self.process.returncode}'}")
+
+class MoviepyEncoder:
+    # MoviePy's ffmpeg writer, which the videos were encoded with before the pipe; it picks the
+    # pixel format itself, so it only takes x264 with the default one
+    def __init__(self, output_path, size, fps, encoder_settings, threads, extra_params=()):
+        from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+        settings = dict(DEFAULT_ENCODER_SETTINGS, **(encoder_settings or {}))
+        self.writer = FFMPEG_VideoWriter(output_path, size, fps, codec=VIDEO_CODECS[settings['codec']]['encoder'], preset=settings['preset'],
+                                         threads=threads, ffmpeg_params=['-crf', str(settings['crf'])] + list(extra_params))
+
+    def write_frame(self, frame):
+        self.writer.write_frame(frame)
+
+    def close(self):
+        self.writer.close()
+
+VIDEO_ENCODER_BACKENDS = {
+    'ffmpeg': FFmpegPipeEncoder,
+    'moviepy': MoviepyEncoder,
+}
+
+def open_video_encoder(output_path, size, fps, encoder_settings=None, threads=1, extra_params=()):
+    # threads is used when the settings leave the thread count at 0 (automatic)
+    settings = dict(DEFAULT_ENCODER_SETTINGS, **(encoder_settings or {}))
+    return VIDEO_ENCODER_BACKENDS[settings['backend']](output_path, size, fps, settings, settings['threads'] or threads, extra_params)
+
+def concat_video_segments(segment_paths, output_path):
+    # Joins videos encoded with the same settings one after the other without re-encoding them
+    if len(segment_paths) == 1:
+        shutil.copyfile(segment_paths[0], output_path)
+        return
+    list_file, list_path = tempfile.mkstemp(suffix='.txt')
+    try:
+        with os.fdopen(list_file, 'w') as segment_list:
+            for segment_path in segment_paths:
+                escaped_path = os.path.abspath(segment_path).replace("'", "'\\''")
+                segment_list.write(f"file '{escaped_path}'\n")
+        command = [get_ffmpeg_binary(), '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+                   '-c', 'copy', output_path]
+        process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            error = process.stderr.decode('utf-8', 'replace').strip()
+            raise IOError(f"ffmpeg failed to join {len(segment_paths)} segments into {output_path}: {error or f'exit status {process.returncode}'}")
+    finally:
+        os.remove(list_path)
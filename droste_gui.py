@@ -0,0 +1,435 @@
+import datetime
+import os
+import queue
+import sys
+import threading
+import tkinter as tk
+import tkinter.ttk as ttk
+import traceback
+from tkinter import filedialog, messagebox
+from PIL import Image, ImageTk
+from droste_checkpoint import validate_resume
+from droste_core import build_animation_path, build_droste_renderer, create_droste_image_effect, set_progress_callback, validate_animation_format, validate_parameters
+from droste_encoders import build_encoder_settings
+
+# Longest side of the downscaled copy of the image that previews are rendered from
+PREVIEW_SIZE = 320
+
+# Milliseconds the parameters have to stay unchanged before a new preview is rendered
+PREVIEW_DELAY_MS = 250
+
+# Milliseconds between checks for finished previews and render progress
+POLL_INTERVAL_MS = 50
+
+class RenderCancelled(Exception):
+    pass
+
+def load_preview_image(image_path):
+    # Downscaled RGBA copy of the image; JPEG files are decoded at a reduced size to begin with
+    with Image.open(image_path) as source_file:
+        source_file.draft('RGB', (PREVIEW_SIZE, PREVIEW_SIZE))
+        preview_image = source_file.convert('RGBA')
+    preview_image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE), Image.Resampling.LANCZOS)
+    return preview_image
+
+def render_droste_preview(preview_image, shrink_factor, max_iterations, resampling_method, rotation_angle, is_stale):
+    # Last frame of the effect rendered from the downscaled image, whose layers nest the same way as
+    # at full size. Gives up and returns None as soon as is_stale() reports newer parameters.
+    renderer = build_droste_renderer(preview_image, shrink_factor, max_iterations, resampling_method, rotation_angle)
+    final_image = None
+    for _, frame in renderer.iter_frames():
+        if is_stale():
+            return None
+        final_image = frame
+    return final_image.copy() if final_image is not None else None
+
+class CustomDialog(tk.Toplevel):
+    # Parameter dialog with a live preview. Previews and the full-resolution render run on background
+    # threads, which report back through a queue the dialog polls, so the Tk main loop never waits on
+    # them. With a render_function, Submit passes it the validated parameters; it raises ValueError for
+    # options it rejects, which the dialog shows, or returns the function the render thread runs while
+    # a progress bar follows the render. Without one the dialog just returns the parameters.
+    def __init__(self, parent, file_path, render_function=None):
+        super().__init__(parent)
+        self.file_path = file_path
+        self.render_function = render_function
+        self.title("Droste Effect Parameters")
+        self.events = queue.Queue()
+        # Every new preview request makes the ones still rendering stale
+        self.preview_generation = 0
+        self.preview_after_id = None
+        self.preview_image = None
+        self.preview_photo = None
+        self.render_thread = None
+        self.render_job = None
+        self.render_result = None
+        self.cancel_requested = False
+        self.create_widgets()
+        self.result = None
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        threading.Thread(target=self.load_preview, daemon=True).start()
+        self.after(POLL_INTERVAL_MS, self.poll_events)
+
+    def create_widgets(self):
+        # Grid layout for better alignment and spacing
+        self.grid_columnconfigure(1, weight=1)
+        row = 0
+
+        # Helper function to create labeled entry or combobox
+        def create_labeled_input(label, input_type, options=None, default=None, preview=False):
+            nonlocal row
+            tk.Label(self, text=label).grid(row=row, column=0, sticky='w', padx=5, pady=5)
+            if input_type == 'entry':
+                widget = tk.Entry(self)
+                if default is not None:
+                    widget.insert(0, default)
+            elif input_type == 'combobox':
+                var = tk.StringVar()
+                widget = ttk.Combobox(self, textvariable=var, values=options, state="readonly")
+                if default is not None:
+                    widget.set(default)
+            widget.grid(row=row, column=1, sticky='ew', padx=5, pady=5)
+            if preview:
+                # Parameters the preview depends on render a new one once they stop changing
+                widget.bind('<<ComboboxSelected>>' if input_type == 'combobox' else '<KeyRelease>', self.schedule_preview)
+            row += 1
+            return widget
+
+        self.shrink_factor_entry = create_labeled_input("Shrink Factor (0.01 to 1.00):", 'entry', default="0.95", preview=True)
+        self.max_iterations_entry = create_labeled_input("Max Iterations:", 'entry', default="100", preview=True)
+        self.save_timelapse_entry = create_labeled_input("Save Timelapse:", 'combobox', options=["yes", "no"], default="yes")
+        self.fps_entry = create_labeled_input("FPS for Timelapse:", 'entry', default="20")
+        self.include_reverse_entry = create_labeled_input("Include Reverse in Video:", 'combobox', options=["yes", "no"], default="no")
+        self.save_reversed_entry = create_labeled_input("Save Reversed Clip:", 'combobox', options=["yes", "no"], default="yes")
+        self.resampling_method_entry = create_labeled_input("Resampling Method:", 'combobox', options=["Nearest", "Box", "Bilinear", "Hamming", "Bicubic", "Lanczos"], default="Bilinear", preview=True)
+        self.rotation_angle_entry = create_labeled_input("Rotation Angle:", 'entry', default="5", preview=True)
+        self.output_format_entry = create_labeled_input("Output Format:", 'combobox', options=["png", "jpg", "jpeg", "bmp", "webp"], default="png")
+        self.resume_entry = create_labeled_input("Resume From Checkpoint:", 'combobox', options=["yes", "no"], default="no")
+        # Creating a frame to hold the output path entry and browse button
+        output_path_frame = tk.Frame(self)
+        output_path_frame.grid(row=row, column=1, sticky='ew', padx=5, pady=5)
+        self.output_path_entry = tk.Entry(output_path_frame)
+        self.output_path_entry.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        # Browse button placed inside the frame, next to the output path entry
+        self.browse_button = tk.Button(output_path_frame, text="...", command=self.browse_output_path, width=3)
+        self.browse_button.pack(side=tk.LEFT, padx=(0, 5))
+
+        # Label for the output path
+        tk.Label(self, text="Output Path: (Leave Empty for Script's Directory)").grid(row=row, column=0, sticky='w', padx=5, pady=5)
+
+        row += 1
+
+        # Preview panel to the right of the parameters, at a fixed size so the layout does not jump
+        preview_frame = tk.Frame(self, width=PREVIEW_SIZE, height=PREVIEW_SIZE)
+        preview_frame.grid(row=0, column=2, rowspan=row - 1, padx=5, pady=5, sticky='n')
+        preview_frame.grid_propagate(False)
+        preview_frame.pack_propagate(False)
+        self.preview_label = tk.Label(preview_frame, text="Loading preview...")
+        self.preview_label.pack(fill=tk.BOTH, expand=True)
+        self.preview_status = tk.Label(self, text="", anchor='w')
+        self.preview_status.grid(row=row - 1, column=2, sticky='ew', padx=5, pady=5)
+
+        self.submit_button = tk.Button(self, text="Submit", command=self.on_submit)
+        self.submit_button.grid(row=row, column=0, columnspan=3, padx=5, pady=5)
+        row += 1
+
+        # Shown while the full-resolution render runs
+        self.progress_bar = ttk.Progressbar(self, mode='determinate', maximum=1)
+        self.progress_bar.grid(row=row, column=0, columnspan=3, sticky='ew', padx=5, pady=(5, 0))
+        self.progress_label = tk.Label(self, text="", anchor='w')
+        self.progress_label.grid(row=row + 1, column=0, columnspan=3, sticky='ew', padx=5, pady=(0, 5))
+        self.progress_bar.grid_remove()
+        self.progress_label.grid_remove()
+
+    def browse_output_path(self):
+        directory = filedialog.askdirectory()
+        if directory:
+            self.output_path_entry.delete(0, tk.END)
+            self.output_path_entry.insert(0, directory)
+
+    def update_gui_defaults(self, command_line_args):
+        self.shrink_factor_entry.delete(0, tk.END)
+        self.shrink_factor_entry.insert(0, str(command_line_args.shrink_factor))
+
+        self.max_iterations_entry.delete(0, tk.END)
+        self.max_iterations_entry.insert(0, str(command_line_args.max_iterations))
+
+        self.save_timelapse_entry.set("yes" if command_line_args.save_timelapse else "no")
+        self.fps_entry.delete(0, tk.END)
+        self.fps_entry.insert(0, str(command_line_args.fps))
+
+        self.include_reverse_entry.set("yes" if command_line_args.include_reverse else "no")
+        self.save_reversed_entry.set("yes" if command_line_args.save_reversed else "no")
+
+        self.resampling_method_entry.set(command_line_args.resampling_method.capitalize())
+        self.rotation_angle_entry.delete(0, tk.END)
+        self.rotation_angle_entry.insert(0, str(command_line_args.rotation_angle))
+
+        self.output_format_entry.set(command_line_args.output_format.lower())
+        self.resume_entry.set("yes" if command_line_args.resume else "no")
+
+        if command_line_args.output_path:
+            self.output_path_entry.delete(0, tk.END)
+            self.output_path_entry.insert(0, command_line_args.output_path)
+        self.schedule_preview()
+
+    def load_preview(self):
+        # Runs on its own thread, so a large image does not hold up the dialog
+        try:
+            self.events.put(('preview_image', load_preview_image(self.file_path)))
+        except Exception as e:
+            self.events.put(('preview_error', self.preview_generation, f"No preview: {e}"))
+
+    def schedule_preview(self, event=None):
+        # Debounce: only the last change within PREVIEW_DELAY_MS starts a render
+        if self.preview_after_id is not None:
+            self.after_cancel(self.preview_after_id)
+        self.preview_after_id = self.after(PREVIEW_DELAY_MS, self.start_preview)
+
+    def start_preview(self):
+        self.preview_after_id = None
+        if self.preview_image is None or self.render_thread is not None:
+            return
+        self.preview_generation += 1
+        try:
+            params = validate_parameters(
+                self.file_path, self.shrink_factor_entry.get(), self.max_iterations_entry.get(), 'no', '10', 'no', 'no',
+                self.resampling_method_entry.get(), self.rotation_angle_entry.get(), 'png', '', False)
+        except ValueError as e:
+            self.preview_status.config(text=str(e))
+            return
+        self.preview_status.config(text="Rendering preview...")
+        threading.Thread(target=self.render_preview, args=(self.preview_generation, params), daemon=True).start()
+
+    def render_preview(self, generation, params):
+        # Runs on a preview thread; the result is dropped if the parameters changed in the meantime
+        try:
+            preview = render_droste_preview(self.preview_image, params['shrink_factor'], params['max_iterations'], params['resampling_method'],
+                                            params['rotation_angle'], lambda: generation != self.preview_generation)
+            if preview is not None:
+                self.events.put(('preview', generation, preview))
+        except Exception as e:
+            self.events.put(('preview_error', generation, f"No preview: {e}"))
+
+    def poll_events(self):
+        # Handles what the background threads reported, on the Tk thread
+        if not self.winfo_exists():
+            return
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == 'preview_image':
+                self.preview_image = event[1]
+                self.start_preview()
+            elif event[0] == 'preview' and event[1] == self.preview_generation:
+                self.preview_photo = ImageTk.PhotoImage(event[2])
+                self.preview_label.config(image=self.preview_photo, text="")
+                self.preview_status.config(text=f"Preview at {event[2].size[0]}x{event[2].size[1]}")
+            elif event[0] == 'preview_error' and event[1] == self.preview_generation:
+                self.preview_label.config(image='', text="")
+                self.preview_status.config(text=event[2])
+            elif event[0] == 'progress':
+                _, iteration, frame_count = event
+                self.progress_bar.config(maximum=frame_count, value=iteration + 1)
+                if iteration + 1 < frame_count:
+                    self.progress_label.config(text=f"Rendering iteration {iteration + 1} of {frame_count}...")
+                else:
+                    self.progress_label.config(text="Saving the image and encoding the videos...")
+            elif event[0] == 'done':
+                self.finish_render(event[1])
+                if not self.winfo_exists():
+                    return
+        self.after(POLL_INTERVAL_MS, self.poll_events)
+
+    def start_render(self):
+        # Stop any preview still rendering; the full render gets the CPU to itself
+        self.preview_generation += 1
+        self.submit_button.config(state=tk.DISABLED)
+        self.progress_bar.config(value=0)
+        self.progress_bar.grid()
+        self.progress_label.config(text="Starting the render...")
+        self.progress_label.grid()
+        self.render_thread = threading.Thread(target=self.run_render, daemon=True)
+        self.render_thread.start()
+
+    def run_render(self):
+        # Runs on the render thread; the renderer reports every iteration through the progress callback
+        def report_progress(iteration, frame_count):
+            if self.cancel_requested:
+                raise RenderCancelled("The render was cancelled.")
+            self.events.put(('progress', iteration, frame_count))
+
+        set_progress_callback(report_progress)
+        render_result = (False, [])
+        try:
+            render_result = self.render_job()
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            traceback.print_exc()
+        finally:
+            set_progress_callback(None)
+            self.events.put(('done', render_result))
+
+    def finish_render(self, render_result):
+        self.render_thread = None
+        self.render_result = render_result
+        success, output_paths = render_result
+        if self.cancel_requested:
+            self.destroy()
+        elif success:
+            messagebox.showinfo("Droste Effect", "Saved:\n" + "\n".join(output_paths), parent=self)
+            self.destroy()
+        else:
+            messagebox.showerror("Render Failed", "The render did not complete; see the console for details.", parent=self)
+            self.submit_button.config(state=tk.NORMAL)
+            self.progress_bar.grid_remove()
+            self.progress_label.grid_remove()
+
+    def on_close(self):
+        if self.render_thread is None:
+            self.result = None
+            self.destroy()
+        elif messagebox.askyesno("Cancel Render", "Stop the render in progress?", parent=self):
+            # The render stops at its next iteration; the dialog closes once it has
+            self.cancel_requested = True
+            self.progress_label.config(text="Cancelling...")
+
+    def on_submit(self):
+        try:
+            # Collecting input values as strings
+            shrink_factor_str = self.shrink_factor_entry.get()
+            max_iterations_str = self.max_iterations_entry.get()
+            save_timelapse_str = self.save_timelapse_entry.get().lower()
+            fps_str = self.fps_entry.get()
+            include_reverse_str = self.include_reverse_entry.get().lower()
+            save_reversed_str = self.save_reversed_entry.get().lower()
+            resampling_method = self.resampling_method_entry.get()
+            rotation_angle_str = self.rotation_angle_entry.get().lower()
+            output_format = self.output_format_entry.get().lower()
+
+            output_path = self.output_path_entry.get().strip()
+            is_output_format_provided = False
+            
+            # Validate and process the parameters
+            validated_params = validate_parameters(
+                self.file_path,
+                shrink_factor_str, max_iterations_str, save_timelapse_str, fps_str,
+                include_reverse_str, save_reversed_str, resampling_method,
+                rotation_angle_str, output_format, output_path,
+                is_output_format_provided
+            )
+
+            # If validation is successful, set the result
+            self.result = validated_params
+            self.result['output_path'] = output_path
+            self.result['resume'] = self.resume_entry.get().lower() == 'yes'
+            if self.render_function is None:
+                self.destroy()
+            else:
+                self.render_job = self.render_function(self.result)
+                self.start_render()
+        except ValueError as e:
+            messagebox.showerror("Input Error", str(e))
+
+def run_gui(args):
+    try:
+        # Set up a root window for the file dialog (but don't display it)
+        root = tk.Tk()
+        root.withdraw()
+
+        # Notify user to be patient
+        print("Please select an image file. This may take a few moments...")
+
+        # Open a file dialog to select an image
+        file_path = filedialog.askopenfilename(title="Select an Image", filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.bmp;*.webp")])
+        if not file_path:
+            print("No file selected. Exiting the program.")
+            sys.exit(0)
+
+        def prepare_render(result):
+            # Runs when the parameters are submitted. The command-line options are checked against the
+            # same rules as in command-line mode, so the dialog reports a bad value instead of the
+            # render quietly using another one.
+            if args.max_frames_in_flight <= 0:
+                raise ValueError("Max frames in flight must be a positive integer.")
+            if args.workers <= 0:
+                raise ValueError("Workers must be a positive integer.")
+            if args.cache_size_mb <= 0:
+                raise ValueError("Cache size must be a positive integer.")
+            if args.max_memory_mb < 0:
+                raise ValueError("Max memory must be zero or a positive integer.")
+            if args.min_layer_size <= 0:
+                raise ValueError("Min layer size must be a positive integer.")
+            if args.change_epsilon < 0:
+                raise ValueError("Change epsilon must be zero or a positive number.")
+            if args.pyramid and (args.engine != 'composite' or args.max_memory_mb):
+                raise ValueError("The image pyramid is only supported by the composite engine without a memory ceiling.")
+            if args.max_memory_mb and (args.workers > 1 or args.engine != 'composite'):
+                raise ValueError("A memory ceiling is only supported by the composite engine with a single worker.")
+            animation_format = validate_animation_format(args.animation_format)
+            validate_resume(result['resume'], args.duplicate_frames, animation_format)
+            encoder_settings = build_encoder_settings(args.video_encoder, args.codec, args.preset, args.crf, args.encoder_threads, args.pix_fmt)
+
+            def render():
+                # Runs on the dialog's render thread
+                # Use the provided output path if available, otherwise default to the current working directory
+                output_base_path = result.get('output_path', os.getcwd())
+                if output_base_path and not os.path.exists(output_base_path):
+                    os.makedirs(output_base_path)
+
+                # Generate filenames for the output files
+                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+                base_filename = os.path.splitext(os.path.basename(file_path))[0]
+                final_output_base = os.path.join(output_base_path, f"{base_filename}_{timestamp}")
+
+                output_image_path = f"{final_output_base}.{result['output_format']}"
+                timelapse_video_path = f"{final_output_base}_timelapse.mp4" if result['save_timelapse'] else None
+                reversed_clip_path = f"{final_output_base}_reversed.mp4" if result['save_reversed'] else None
+                animation_path = build_animation_path(output_image_path, animation_format)
+
+                success = create_droste_image_effect(
+                    file_path, output_image_path, result['shrink_factor'], result['max_iterations'],
+                    result['save_timelapse'], result['fps'], result['include_reverse'], timelapse_video_path,
+                    reversed_clip_path, result['save_reversed'],
+                    result['resampling_method'], result['rotation_angle'], result['output_format'],
+                    stream_frames=args.stream_frames, max_frames_in_flight=args.max_frames_in_flight,
+                    workers=args.workers, engine=args.engine,
+                    cache_dir=args.cache_dir or None, cache_size_mb=args.cache_size_mb,
+                    max_memory_mb=args.max_memory_mb or None,
+                    min_layer_size=args.min_layer_size, change_epsilon=args.change_epsilon,
+                    duplicate_frames=args.duplicate_frames, pyramid=args.pyramid,
+                    encoder_settings=encoder_settings, animation_format=animation_format, resume=result['resume']
+                )
+                if success:
+                    print(f"Image saved as {output_image_path}")
+                    if result['save_timelapse']:
+                        print(f"Time-lapse video saved as {timelapse_video_path}")
+                    if result['save_reversed']:
+                        print(f"Reversed clip saved as {reversed_clip_path}")
+                    if animation_path:
+                        print(f"Animation saved as {animation_path}")
+                return success, [path for path in (output_image_path, timelapse_video_path, reversed_clip_path, animation_path) if path]
+
+            return render
+
+        dialog = CustomDialog(root, file_path, prepare_render)
+        dialog.update_gui_defaults(args)
+        root.wait_window(dialog)
+
+        if dialog.result is None:
+            print("Operation cancelled by the user. Exiting the program.")
+            sys.exit(0)
+        if dialog.cancel_requested:
+            print("Render cancelled by the user.")
+            sys.exit(0)
+        if dialog.render_result is None or not dialog.render_result[0]:
+            print("The render did not complete.")
+            sys.exit(1)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        traceback.print_exc()
+        sys.exit(1)
@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Order stages are listed in, following the pipeline; anything else recorded is appended after them
+PROFILE_STAGES = [
+    'decode', 'measure', 'pyramid', 'resize', 'rotate', 'composite', 'inverse_map', 'layer_wait',
+    'frame_save', 'frame_load', 'frame_convert', 'encode', 'animation', 'checkpoint', 'final_save',
+]
+
+# The profiler of the run in progress, if it is being profiled
+current_profiler = None
+
+NOT_PROFILED = nullcontext()
+
+class StageProfiler:
+    # Collects wall and CPU time per pipeline stage, in total and per iteration. Stages run on the
+    # render, producer and encoder threads alike, so CPU time is taken from the thread doing the
+    # work; the ffmpeg encoders and render workers are separate processes and are counted as
+    # child CPU time once they have exited. Render workers also time their stages themselves, and
+    # their timings are merged in as their layers arrive.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.iterations = {}
+        self.bytes_written = {}
+        self.frame_count = 0
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.start_child_cpu = self.get_child_cpu()
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.child_cpu_seconds = None
+
+    def get_child_cpu(self):
+        times = os.times()
+        return times.children_user + times.children_system
+
+    @contextmanager
+    def stage(self, name, iteration=None):
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start_wall, time.thread_time() - start_cpu, iteration)
+
+    def record(self, name, wall_seconds, cpu_seconds, iteration=None):
+        with self.lock:
+            totals = self.stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0})
+            totals['wall_seconds'] += wall_seconds
+            totals['cpu_seconds'] += cpu_seconds
+            totals['calls'] += 1
+            if iteration is not None:
+                iteration_stages = self.iterations.setdefault(iteration, {})
+                times = iteration_stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+                times['wall_seconds'] += wall_seconds
+                times['cpu_seconds'] += cpu_seconds
+
+    def get_timings(self):
+        # Stage totals and per-iteration times, for merging into the profiler of another process
+        with self.lock:
+            return {'stages': self.stages, 'iterations': self.iterations}
+
+    def merge_timings(self, timings):
+        with self.lock:
+            for name, times in timings['stages'].items():
+                totals = self.stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0})
+                for key, value in times.items():
+                    totals[key] += value
+            for iteration, stages in timings['iterations'].items():
+                iteration_stages = self.iterations.setdefault(iteration, {})
+                for name, times in stages.items():
+                    iteration_times = iteration_stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+                    for key, value in times.items():
+                        iteration_times[key] += value
+
+    def add_frame(self):
+        with self.lock:
+            self.frame_count += 1
+
+    def add_file(self, kind, path):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self.lock:
+            self.bytes_written[kind] = self.bytes_written.get(kind, 0) + size
+
+    def stop(self):
+        self.wall_seconds = time.perf_counter() - self.start_wall
+        self.cpu_seconds = time.process_time() - self.start_cpu
+        self.child_cpu_seconds = self.get_child_cpu() - self.start_child_cpu
+
+    def ordered_stages(self, stages):
+        names = [name for name in PROFILE_STAGES if name in stages]
+        return names + sorted(name for name in stages if name not in PROFILE_STAGES)
+
+    def build_report(self, details=None, peak_memory=None):
+        if self.wall_seconds is None:
+            self.stop()
+        round_times = lambda times: {key: round(value, 6) if isinstance(value, float) else value for key, value in times.items()}
+        report = dict(details or {})
+        report.update({
+            'wall_seconds': round(self.wall_seconds, 6),
+            'cpu_seconds': round(self.cpu_seconds, 6),
+            'child_cpu_seconds': round(self.child_cpu_seconds, 6),
+            'frames': self.frame_count,
+            'frames_per_second': round(self.frame_count / self.wall_seconds, 3) if self.wall_seconds else None,
+            'bytes_written': dict(self.bytes_written, total=sum(self.bytes_written.values())),
+            'peak_memory_mb': None,
+            'stages': {name: round_times(self.stages[name]) for name in self.ordered_stages(self.stages)},
+            'iterations': [
+                {'iteration': iteration,
+                 'stages': {name: round_times(stages[name]) for name in self.ordered_stages(stages)}}
+                for iteration, stages in sorted(self.iterations.items())
+            ],
+        })
+        if peak_memory is not None:
+            report['peak_memory_mb'] = {'process': round(peak_memory[0], 1), 'largest_child': round(peak_memory[1], 1)}
+        return report
+
+    def print_summary(self):
+        if self.wall_seconds is None:
+            self.stop()
+        print("\nStage Timings:")
+        print(f"{'Stage':<14}{'Wall (s)':>10}{'CPU (s)':>10}{'Calls':>8}")
+        for name in self.ordered_stages(self.stages):
+            totals = self.stages[name]
+            print(f"{name:<14}{totals['wall_seconds']:>10.3f}{totals['cpu_seconds']:>10.3f}{totals['calls']:>8}")
+        print(f"{'total':<14}{self.wall_seconds:>10.3f}{self.cpu_seconds:>10.3f}")
+        print(f"Child process CPU time: {self.child_cpu_seconds:.3f} seconds")
+        if self.frame_count and self.wall_seconds:
+            print(f"Frames: {self.frame_count} ({self.frame_count / self.wall_seconds:.2f} frames per second)")
+        print(f"Bytes written: {sum(self.bytes_written.values())}")
+
+def start_profiling():
+    global current_profiler
+    current_profiler = StageProfiler()
+    return current_profiler
+
+def stop_profiling():
+    global current_profiler
+    profiler = current_profiler
+    current_profiler = None
+    if profiler is not None:
+        profiler.stop()
+    return profiler
+
+def profile_stage(name, iteration=None):
+    # Times a stage of the run being profiled; a shared no-op otherwise, so unprofiled runs pay
+    # for little more than this call
+    if current_profiler is None:
+        return NOT_PROFILED
+    return current_profiler.stage(name, iteration)
+
+def is_profiling():
+    return current_profiler is not None
+
+def merge_profile_timings(timings):
+    if current_profiler is not None and timings is not None:
+        current_profiler.merge_timings(timings)
+
+def profile_frame():
+    if current_profiler is not None:
+        current_profiler.add_frame()
+
+def profile_file(kind, path):
+    if current_profiler is not None:
+        current_profiler.add_file(kind, path)
+
+def save_profile_report(report, report_path):
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    print(f"Performance report saved as {report_path}")
@@ -0,0 +1,353 @@
+import importlib
+import json
+import multiprocessing
+import os
+import signal
+import socketserver
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from droste_batch import get_batch_output_name, get_worker_recycling_options, prepare_batch_job
+from droste_core import create_droste_image_effect, set_progress_callback
+
+# Finished jobs remembered for status requests; the oldest are forgotten first
+SERVICE_JOB_HISTORY = 500
+
+# Seconds a client turned away by a full queue is asked to wait before retrying
+SERVICE_RETRY_AFTER = 5
+
+# Seconds between keep-alive lines on an idle progress stream
+SERVICE_EVENT_KEEPALIVE = 15
+
+# Where the progress of the job a worker is running is sent, set when the worker starts
+worker_progress_queue = None
+
+def init_service_worker(progress_queue):
+    global worker_progress_queue
+    worker_progress_queue = progress_queue
+    # Workers stay up between jobs, so the video modules are only imported once per worker
+    for module_name in ['droste_video', 'droste_encoders', 'droste_animation']:
+        importlib.import_module(module_name)
+
+def run_service_job(job_id, args, kwargs, output_paths):
+    # Runs in a worker process; progress and the result go back through the progress queue, in order
+    start_time = time.time()
+    set_progress_callback(lambda iteration, frame_count: worker_progress_queue.put(
+        (job_id, {'event': 'progress', 'iteration': iteration, 'frame_count': frame_count})))
+    result = {'event': 'result', 'status': 'failed', 'outputs': [], 'error': None}
+    try:
+        success = create_droste_image_effect(*args, **kwargs)
+        result['status'] = 'ok' if success else 'failed'
+        if not success:
+            result['error'] = "Rendering did not complete; see the service log for details."
+        result['outputs'] = [path for path in output_paths if path and os.path.exists(path)]
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
+    finally:
+        set_progress_callback(None)
+    result['elapsed'] = round(time.time() - start_time, 3)
+    worker_progress_queue.put((job_id, result))
+
+class DrosteRenderService:
+    # Queue of render jobs run by a pool of long-lived worker processes, at most `workers` at a time.
+    # At most max_queued_jobs wait for a worker; further jobs are turned away until there is room,
+    # so a burst of requests cannot pile up without limit. Workers are recycled after a number of
+    # jobs like batch workers, and a job whose worker crashes is reported as failed.
+    def __init__(self, defaults, workers, max_queued_jobs):
+        self.defaults = defaults
+        self.workers = workers
+        self.max_queued_jobs = max_queued_jobs
+        self.condition = threading.Condition()
+        self.jobs = OrderedDict()
+        self.waiting = deque()
+        self.running = {}
+        self.context = multiprocessing.get_context('spawn')
+        self.progress_queue = self.context.Queue()
+        self.executor = self.new_executor()
+        self.listener = threading.Thread(target=self.listen_for_progress, daemon=True)
+        self.listener.start()
+
+    def new_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=self.context, **get_worker_recycling_options(),
+                                   initializer=init_service_worker, initargs=(self.progress_queue,))
+
+    def submit(self, job):
+        # Validates the job before it is queued; returns None when the queue is full. Jobs run side
+        # by side, so each one's outputs are named after its job id as well as the image.
+        job_id = uuid.uuid4().hex
+        if isinstance(job.get('image_path'), str) and job['image_path']:
+            job = dict(job, output_name=f"{get_batch_output_name(job)}_{job_id}")
+        args, kwargs, output_paths = prepare_batch_job(job, self.defaults)
+        with self.condition:
+            if len(self.waiting) >= self.max_queued_jobs:
+                return None
+            self.jobs[job_id] = {
+                'id': job_id,
+                'image_path': job['image_path'],
+                'status': 'queued',
+                'submitted': time.time(),
+                'started': None,
+                'finished': None,
+                'iteration': None,
+                'frame_count': None,
+                'outputs': [],
+                'expected_outputs': [path for path in output_paths if path],
+                'error': None,
+                'elapsed': None,
+                'events': [{'event': 'status', 'status': 'queued'}],
+            }
+            self.waiting.append((job_id, args, kwargs, output_paths))
+            self.dispatch()
+            return self.describe(job_id)
+
+    def dispatch(self):
+        # Called with the condition held
+        while self.waiting and len(self.running) < self.workers:
+            job_id, args, kwargs, output_paths = self.waiting.popleft()
+            job = self.jobs[job_id]
+            job['status'] = 'running'
+            job['started'] = time.time()
+            self.add_event(job, {'event': 'status', 'status': 'running'})
+            future = self.executor.submit(run_service_job, job_id, args, kwargs, output_paths)
+            self.running[job_id] = future
+            future.add_done_callback(lambda future, job_id=job_id, executor=self.executor: self.job_done(job_id, future, executor))
+
+    def job_done(self, job_id, future, executor):
+        with self.condition:
+            self.running.pop(job_id, None)
+            try:
+                future.result()
+            except BrokenProcessPool:
+                self.finish(self.jobs[job_id], {'status': 'failed', 'error': "The worker process running this job exited unexpectedly."})
+                # Every job of a broken pool fails at once; only the first of them replaces the pool,
+                # so later ones do not tear down the replacement and the jobs just sent to it
+                if executor is self.executor:
+                    executor.shutdown(wait=False)
+                    self.executor = self.new_executor()
+            except Exception as e:
+                self.finish(self.jobs[job_id], {'status': 'failed', 'error': f"{type(e).__name__}: {e}"})
+            self.dispatch()
+
+    def cancel(self, job_id):
+        # Only jobs still waiting for a worker can be cancelled
+        with self.condition:
+            for entry in self.waiting:
+                if entry[0] == job_id:
+                    self.waiting.remove(entry)
+                    self.finish(self.jobs[job_id], {'status': 'cancelled'})
+                    return True
+            return False
+
+    def listen_for_progress(self):
+        while True:
+            message = self.progress_queue.get()
+            if message is None:
+                return
+            job_id, event = message
+            with self.condition:
+                job = self.jobs.get(job_id)
+                if job is None or job['finished'] is not None:
+                    continue
+                if event['event'] == 'progress':
+                    job['iteration'] = event['iteration']
+                    job['frame_count'] = event['frame_count']
+                    self.add_event(job, event)
+                else:
+                    self.finish(job, event)
+
+    def add_event(self, job, event):
+        job['events'].append(event)
+        self.condition.notify_all()
+
+    def finish(self, job, result):
+        # Called with the condition held
+        job['finished'] = time.time()
+        for key in ('status', 'outputs', 'error', 'elapsed'):
+            if key in result:
+                job[key] = result[key]
+        self.add_event(job, {'event': 'status', 'status': job['status']})
+        finished = [job_id for job_id, job in self.jobs.items() if job['finished'] is not None]
+        for job_id in finished[:max(0, len(finished) - SERVICE_JOB_HISTORY)]:
+            del self.jobs[job_id]
+
+    def describe(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        return {key: value for key, value in job.items() if key != 'events'}
+
+    def iter_events(self, job_id):
+        # Every event of a job from the start, waiting for new ones until the job has finished;
+        # None is yielded while nothing happens, so the caller can keep the connection alive
+        position = 0
+        while True:
+            with self.condition:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    return
+                if position >= len(job['events']) and job['finished'] is None:
+                    self.condition.wait(SERVICE_EVENT_KEEPALIVE)
+                events = job['events'][position:]
+                position += len(events)
+                finished = job['finished'] is not None and position >= len(job['events'])
+            for event in events:
+                yield event
+            if finished:
+                yield dict(self.describe(job_id) or {}, event='done')
+                return
+            if not events:
+                yield None
+
+    def get_health(self):
+        with self.condition:
+            return {
+                'workers': self.workers,
+                'running': len(self.running),
+                'queued': len(self.waiting),
+                'max_queued_jobs': self.max_queued_jobs,
+            }
+
+    def close(self):
+        with self.condition:
+            for job_id, _, _, _ in list(self.waiting):
+                self.finish(self.jobs[job_id], {'status': 'cancelled'})
+            self.waiting.clear()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.progress_queue.put(None)
+        self.listener.join()
+
+class DrosteServiceHandler(BaseHTTPRequestHandler):
+    # POST /jobs                  queue a job (a JSON object with the batch manifest parameters)
+    # GET /jobs                   every job the service remembers
+    # GET /jobs/<id>              one job's status, progress and outputs
+    # GET /jobs/<id>/events       the job's events as they happen, one JSON object per line
+    # DELETE /jobs/<id>           cancel a job that is still queued
+    # GET /health                 workers, running and queued jobs
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else 'unix'
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body, indent=2).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def get_path_parts(self):
+        return [part for part in self.path.split('?')[0].split('/') if part]
+
+    def do_POST(self):
+        service = self.server.service
+        if self.get_path_parts() != ['jobs']:
+            self.send_json(404, {'error': f"Unknown path: {self.path}"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            job = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(job, dict):
+                raise ValueError("A job must be a JSON object.")
+            job_info = service.submit(job)
+        except json.JSONDecodeError as e:
+            self.send_json(400, {'error': f"Invalid JSON: {e}"})
+            return
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        if job_info is None:
+            self.send_json(503, {'error': "The job queue is full; try again later."}, {'Retry-After': str(SERVICE_RETRY_AFTER)})
+            return
+        self.send_json(202, job_info, {'Location': f"/jobs/{job_info['id']}"})
+
+    def do_GET(self):
+        service = self.server.service
+        parts = self.get_path_parts()
+        if parts == ['health']:
+            self.send_json(200, service.get_health())
+        elif parts == ['jobs']:
+            with service.condition:
+                self.send_json(200, [service.describe(job_id) for job_id in service.jobs])
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            with service.condition:
+                job_info = service.describe(parts[1])
+            if job_info is None:
+                self.send_json(404, {'error': f"Unknown job: {parts[1]}"})
+            else:
+                self.send_json(200, job_info)
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+            self.stream_events(parts[1])
+        else:
+            self.send_json(404, {'error': f"Unknown path: {self.path}"})
+
+    def do_DELETE(self):
+        service = self.server.service
+        parts = self.get_path_parts()
+        if len(parts) != 2 or parts[0] != 'jobs' or parts[1] not in service.jobs:
+            self.send_json(404, {'error': f"Unknown job: {self.path}"})
+        elif service.cancel(parts[1]):
+            self.send_json(200, service.describe(parts[1]))
+        else:
+            self.send_json(409, {'error': "Only queued jobs can be cancelled."})
+
+    def stream_events(self, job_id):
+        if job_id not in self.server.service.jobs:
+            self.send_json(404, {'error': f"Unknown job: {job_id}"})
+            return
+        # The response has no length; it ends when the connection is closed after the last event
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            for event in self.server.service.iter_events(job_id):
+                self.wfile.write((json.dumps(event) if event is not None else '').encode('utf-8') + b'\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def open_service_server(address):
+    # address is unix:<socket path>, <host>:<port> or a port on localhost
+    if address.startswith('unix:'):
+        socket_path = address[len('unix:'):]
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return ThreadingUnixHTTPServer(socket_path, DrosteServiceHandler)
+    host, _, port = address.rpartition(':')
+    try:
+        port = int(port)
+    except ValueError:
+        raise ValueError(f"Invalid service address: {address}. Use <host>:<port>, <port> or unix:<socket path>.")
+    server = ThreadingHTTPServer((host or '127.0.0.1', port), DrosteServiceHandler)
+    server.daemon_threads = True
+    return server
+
+def stop_service(signum, frame):
+    raise KeyboardInterrupt
+
+def run_service(address, defaults, workers, max_queued_jobs):
+    server = open_service_server(address)
+    server.service = DrosteRenderService(defaults, workers, max_queued_jobs)
+    # Stopped by a service manager the same way as by Ctrl+C
+    signal.signal(signal.SIGTERM, stop_service)
+    print(f"Render service listening on {address} with {workers} workers and room for {max_queued_jobs} queued jobs.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping the render service.")
+    finally:
+        server.server_close()
+        server.service.close()
+        if address.startswith('unix:') and os.path.exists(address[len('unix:'):]):
+            os.remove(address[len('unix:'):])
@@ -0,0 +1,239 @@
+import csv
+import itertools
+import math
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from PIL import Image, ImageDraw, ImageFont
+from droste_core import build_droste_renderer, parse_float, save_image_with_format, validate_parameters
+from droste_profile import profile_stage
+
+# Parameters a sweep can vary, in the order variants are named and laid out on the contact sheet,
+# with the prefix each one's value gets in variant names
+SWEEP_PARAMETERS = {
+    'shrink_factor': 'sf',
+    'rotation_angle': 'rot',
+    'resampling_method': '',
+    'max_iterations': 'it',
+}
+
+# Width and height each variant is scaled to fit on the contact sheet
+SWEEP_THUMBNAIL_SIZE = 256
+
+# Guards against a range with a mistyped step expanding into an endless sweep
+SWEEP_MAX_VARIANTS = 1000
+
+SWEEP_LABEL_HEIGHT = 28
+SWEEP_SHEET_MARGIN = 8
+SWEEP_SHEET_BACKGROUND = (40, 40, 40)
+
+def parse_sweep_values(name, values_str):
+    # A comma-separated list, or for numbers an inclusive start:stop:step range (step defaults to 1)
+    if name not in SWEEP_PARAMETERS:
+        raise ValueError(f"Cannot sweep {name}. Choose from {', '.join(SWEEP_PARAMETERS)}.")
+    if name == 'resampling_method':
+        return [value.strip().lower() for value in values_str.split(',') if value.strip()]
+    if ':' not in values_str:
+        return [value.strip() for value in values_str.split(',') if value.strip()]
+    bounds = values_str.split(':')
+    if len(bounds) not in (2, 3):
+        raise ValueError(f"Invalid range for {name}: {values_str}. Use start:stop or start:stop:step.")
+    start = parse_float(bounds[0], f"Start of the {name} range")
+    stop = parse_float(bounds[1], f"End of the {name} range")
+    step = parse_float(bounds[2], f"Step of the {name} range") if len(bounds) == 3 else 1.0
+    if step <= 0:
+        raise ValueError(f"The step of the {name} range must be a positive number.")
+    count = math.floor((stop - start) / step + 1e-9) + 1
+    if count <= 0:
+        raise ValueError(f"The {name} range is empty: {values_str}")
+    if count > SWEEP_MAX_VARIANTS:
+        raise ValueError(f"The {name} range has more than {SWEEP_MAX_VARIANTS} values: {values_str}")
+    # Rounded so steps like 0.03 do not produce values like 0.8800000000000001
+    return [f"{round(start + index * step, 10):g}" for index in range(count)]
+
+def parse_sweep_spec(sweep_items):
+    # name=values items, e.g. shrink_factor=0.85:0.97:0.04 resampling_method=bilinear,lanczos
+    sweep = {}
+    for item in sweep_items:
+        name, separator, values_str = item.partition('=')
+        name = name.strip()
+        if not separator:
+            raise ValueError(f"Invalid sweep parameter: {item}. Use name=values.")
+        if name in sweep:
+            raise ValueError(f"{name} is swept more than once.")
+        values = parse_sweep_values(name, values_str)
+        if not values:
+            raise ValueError(f"No values to sweep for {name}.")
+        sweep[name] = values
+    if not sweep:
+        raise ValueError("Nothing to sweep.")
+    return sweep
+
+def plan_sweep_variants(image_path, sweep, defaults, output_format):
+    # Every combination of the swept values, with the other parameters taken from defaults, validated
+    # the same way as a single render
+    names = [name for name in SWEEP_PARAMETERS if name in sweep]
+    # Contact sheet labels leave out values every variant shares
+    labelled = [name for name in names if len(sweep[name]) > 1] or names
+    variants = []
+    for values in itertools.product(*(sweep[name] for name in names)):
+        params = dict(defaults, **dict(zip(names, values)))
+        validated_params = validate_parameters(
+            image_path, str(params['shrink_factor']), str(params['max_iterations']), 'no', '10', 'no', 'no',
+            str(params['resampling_method']), str(params['rotation_angle']), output_format, '', True)
+        variants.append({
+            'name': '_'.join(f"{SWEEP_PARAMETERS[name]}{value}" for name, value in zip(names, values)),
+            'label': ' '.join(f"{SWEEP_PARAMETERS[name]} {value}".strip() for name, value in zip(names, values) if name in labelled),
+            'shrink_factor': validated_params['shrink_factor'],
+            'rotation_angle': validated_params['rotation_angle'],
+            'resampling_method': validated_params['resampling_method'],
+            'max_iterations': validated_params['max_iterations'],
+        })
+    if len(variants) > SWEEP_MAX_VARIANTS:
+        raise ValueError(f"The sweep has {len(variants)} variants, more than {SWEEP_MAX_VARIANTS}.")
+    return names, variants
+
+# Per-process state of sweep workers, set up by init_sweep_worker
+sweep_worker_state = {}
+
+def init_sweep_worker(source_name, source_size):
+    # Attach to the source decoded once by the parent instead of decoding it in every variant
+    source_memory = shared_memory.SharedMemory(name=source_name)
+    sweep_worker_state['source_memory'] = source_memory
+    sweep_worker_state['source_image'] = Image.frombuffer('RGBA', source_size, source_memory.buf, 'raw', 'RGBA', 0, 1)
+    sweep_worker_state['pyramid_levels'] = None
+
+def render_sweep_variant(variant, engine, min_layer_size, change_epsilon, pyramid, output_path, output_format):
+    # Renders every frame of the variant, as a time-lapse would, and saves the last one. Returns the
+    # timings and a thumbnail for the contact sheet.
+    result = {'name': variant['name'], 'status': 'failed', 'frames': 0, 'render_seconds': None, 'output_path': None, 'error': None}
+    try:
+        start_time = time.perf_counter()
+        renderer = build_droste_renderer(sweep_worker_state['source_image'], variant['shrink_factor'], variant['max_iterations'],
+                                         variant['resampling_method'], variant['rotation_angle'], engine, None, min_layer_size,
+                                         change_epsilon, False, pyramid)
+        if getattr(renderer, 'pyramid', False):
+            # The pyramid only depends on the source, so the worker builds it for its first variant only
+            if sweep_worker_state['pyramid_levels'] is None:
+                renderer.get_resize_source(renderer.source_image.size)
+                sweep_worker_state['pyramid_levels'] = renderer.pyramid_levels
+            renderer.pyramid_levels = sweep_worker_state['pyramid_levels']
+        final_image = None
+        for _, frame in renderer.iter_frames():
+            final_image = frame
+        result['render_seconds'] = time.perf_counter() - start_time
+        result['frames'] = renderer.frame_count
+        if final_image is None:
+            raise ValueError("The image is too small to render any iterations.")
+        if not save_image_with_format(final_image, output_path, output_format):
+            raise IOError(f"Failed to save {output_path}")
+        final_image.thumbnail((SWEEP_THUMBNAIL_SIZE, SWEEP_THUMBNAIL_SIZE), Image.Resampling.BILINEAR)
+        result['thumbnail'] = final_image.convert('RGBA')
+        result['output_path'] = output_path
+        result['status'] = 'ok'
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
+    return result
+
+def build_contact_sheet(variants, results, columns):
+    # One tile per variant in sweep order, labelled with its values and render time
+    thumbnails = [results[variant['name']].get('thumbnail') for variant in variants]
+    tile_width = max([thumbnail.size[0] for thumbnail in thumbnails if thumbnail is not None] + [SWEEP_THUMBNAIL_SIZE])
+    tile_height = max([thumbnail.size[1] for thumbnail in thumbnails if thumbnail is not None] + [1]) + SWEEP_LABEL_HEIGHT
+    rows = math.ceil(len(variants) / columns)
+    sheet = Image.new('RGB', (columns * (tile_width + SWEEP_SHEET_MARGIN) + SWEEP_SHEET_MARGIN,
+                              rows * (tile_height + SWEEP_SHEET_MARGIN) + SWEEP_SHEET_MARGIN), SWEEP_SHEET_BACKGROUND)
+    draw = ImageDraw.Draw(sheet)
+    font = ImageFont.load_default()
+    for index, (variant, thumbnail) in enumerate(zip(variants, thumbnails)):
+        left = SWEEP_SHEET_MARGIN + (index % columns) * (tile_width + SWEEP_SHEET_MARGIN)
+        top = SWEEP_SHEET_MARGIN + (index // columns) * (tile_height + SWEEP_SHEET_MARGIN)
+        result = results[variant['name']]
+        if thumbnail is not None:
+            sheet.paste(thumbnail, (left + (tile_width - thumbnail.size[0]) // 2, top), thumbnail)
+            timing = f"{result['render_seconds']:.2f} s, {result['frames']} frames"
+        else:
+            timing = "failed"
+        label_top = top + tile_height - SWEEP_LABEL_HEIGHT
+        draw.text((left, label_top + 2), variant['label'], fill=(255, 255, 255), font=font)
+        draw.text((left, label_top + 15), timing, fill=(190, 190, 190), font=font)
+    return sheet
+
+def save_sweep_table(table_path, names, variants, results):
+    with open(table_path, 'w', newline='') as table_file:
+        writer = csv.writer(table_file)
+        writer.writerow(['variant'] + names + ['status', 'frames', 'render_seconds', 'ms_per_frame', 'output_path', 'error'])
+        for variant in variants:
+            result = results[variant['name']]
+            seconds = result['render_seconds']
+            writer.writerow([variant['name']] + [variant[name] for name in names] + [
+                result['status'], result['frames'], f"{seconds:.4f}" if seconds is not None else '',
+                f"{1000 * seconds / result['frames']:.2f}" if seconds is not None and result['frames'] else '',
+                result['output_path'] or '', result['error'] or ''])
+
+def print_sweep_table(names, variants, results):
+    rows = [[variant['name']] + [str(variant[name]) for name in names] + [
+        results[variant['name']]['status'], str(results[variant['name']]['frames']),
+        f"{results[variant['name']]['render_seconds']:.2f}" if results[variant['name']]['render_seconds'] is not None else '-']
+        for variant in variants]
+    header = ['variant'] + names + ['status', 'frames', 'seconds']
+    widths = [max(len(row[column]) for row in rows + [header]) for column in range(len(header))]
+    for row in [header] + rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+
+def run_sweep(image_path, output_image_path, output_format, sweep, defaults, workers, engine='composite', min_layer_size=1, change_epsilon=0.0, pyramid=False):
+    # Renders every combination of the swept parameters from a single decode of the source, spread
+    # over worker processes that share the decoded pixels. Each variant's final image goes into
+    # <name>_sweep/, next to a contact sheet (<name>_sweep.png) and a timing table (<name>_sweep.csv).
+    start_time = time.time()
+    names, variants = plan_sweep_variants(image_path, sweep, defaults, output_format)
+    output_base = os.path.splitext(output_image_path)[0]
+    variant_dir = f"{output_base}_sweep"
+    os.makedirs(variant_dir, exist_ok=True)
+    print(f"Sweeping {len(variants)} variants of {image_path} over {', '.join(names)} with {workers} workers.")
+
+    with profile_stage('decode'):
+        with Image.open(image_path) as source_file:
+            source_image = source_file.convert('RGBA')
+    source_bytes = source_image.tobytes()
+    source_memory = shared_memory.SharedMemory(create=True, size=max(1, len(source_bytes)))
+    results = {}
+    try:
+        source_memory.buf[:len(source_bytes)] = source_bytes
+        del source_bytes
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_sweep_worker, initargs=(source_memory.name, source_image.size)) as executor:
+            futures = [executor.submit(render_sweep_variant, variant, engine, min_layer_size, change_epsilon, pyramid,
+                                       os.path.join(variant_dir, f"{variant['name']}.{output_format}"), output_format)
+                       for variant in variants]
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # A worker that died takes its variant with it; the other variants carry on
+                    result = {'name': variants[futures.index(future)]['name'], 'status': 'failed', 'frames': 0,
+                              'render_seconds': None, 'output_path': None, 'error': f"{type(e).__name__}: {e}"}
+                results[result['name']] = result
+                print(f"[{len(results)}/{len(variants)}] {result['name']}: {result['status']}"
+                      + (f" in {result['render_seconds']:.2f} seconds" if result['render_seconds'] is not None else f" ({result['error']})"))
+    finally:
+        source_memory.close()
+        source_memory.unlink()
+
+    # Columns follow the last parameter with more than one value, so each row varies only that one
+    varied = [name for name in names if len(sweep[name]) > 1]
+    columns = len(sweep[varied[-1]]) if len(varied) > 1 else min(len(variants), 8)
+    sheet_path = f"{output_base}_sweep.png"
+    build_contact_sheet(variants, results, columns).save(sheet_path)
+    table_path = f"{output_base}_sweep.csv"
+    save_sweep_table(table_path, names, variants, results)
+
+    print()
+    print_sweep_table(names, variants, results)
+    failed = sum(1 for result in results.values() if result['status'] != 'ok')
+    print(f"\nSweep complete: {len(variants) - failed} succeeded, {failed} failed in {time.time() - start_time:.2f} seconds.")
+    print(f"Contact sheet saved as {sheet_path}")
+    print(f"Timing table saved as {table_path}")
+    return failed == 0
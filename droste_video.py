@@ -0,0 +1,287 @@
+import math
+import os
+import queue
+import threading
+import time
+import traceback
+import numpy as np
+from PIL import Image
+from droste_animation import write_droste_animation
+from droste_profile import profile_file, profile_stage
+from droste_core import generate_droste_frames, load_droste_renderer, open_droste_frame_pool, plan_video_outputs
+from droste_encoders import open_video_encoder
+
+# Total number of encoder threads shared by all videos that are encoded concurrently, unless the
+# encoder settings give a thread count
+ENCODER_THREAD_BUDGET = 8
+
+# A reversed section that follows the forward pass is replayed from the forward frames kept in
+# memory, as long as they fit in this many bytes, instead of loading or rendering them again
+REVERSE_BUFFER_BYTES = 512 * 1024 * 1024
+
+def get_reverse_buffer_bytes(max_memory_mb=None):
+    # Under a memory ceiling the forward frames are not kept for the reversed sections
+    return 0 if max_memory_mb else REVERSE_BUFFER_BYTES
+
+def stream_droste_frames(frames, max_frames_in_flight, result):
+    # Render frames on a producer thread and hand them over through a bounded queue,
+    # so at most max_frames_in_flight converted frames exist at any time
+    frame_queue = queue.Queue(maxsize=max_frames_in_flight)
+    stop_event = threading.Event()
+    end_of_stream = object()
+
+    def put(item):
+        while not stop_event.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for iteration, frame in frames:
+                with profile_stage('frame_convert', iteration):
+                    rgb_frame = np.asarray(frame.convert('RGB'))
+                if not put(rgb_frame):
+                    return
+                result['final_image'] = frame
+        except Exception as e:
+            result['error'] = e
+        finally:
+            put(end_of_stream)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = frame_queue.get()
+            if item is end_of_stream:
+                break
+            yield item
+    finally:
+        stop_event.set()
+        producer.join()
+
+    if 'error' in result:
+        raise result['error']
+
+def save_droste_frames(frames, frame_dir):
+    # Keep a lossless copy of every frame on its way to the encoder
+    for iteration, frame in frames:
+        frame_path = os.path.join(frame_dir, f"frame_{iteration:05d}.png")
+        with profile_stage('frame_save', iteration):
+            frame.save(frame_path, compress_level=1)
+        profile_file('cached_frames', frame_path)
+        yield iteration, frame
+
+def stream_droste_effect_to_videos(image_path, timelapse_video_path, reversed_clip_path, fps, include_reverse, save_reversed, shrink_factor, max_iterations, resampling_method, rotation_angle, max_frames_in_flight, workers=1, engine='composite', frame_dir=None, max_memory_mb=None, min_layer_size=1, change_epsilon=0.0, duplicate_frames='keep', pyramid=False, encoder_settings=None, animation_writer=None, renderer=None):
+    # An animation_writer is given the forward frames on their way to the encoders. A renderer that
+    # is already loaded (such as one resumed from a checkpoint) is used instead of loading the image.
+    start_time = time.time()
+    result = {}
+    outputs = plan_video_outputs(timelapse_video_path, reversed_clip_path, include_reverse, save_reversed)
+    try:
+        if renderer is None:
+            renderer = load_droste_renderer(image_path, shrink_factor, max_iterations, resampling_method, rotation_angle, engine, max_memory_mb,
+                                            min_layer_size, change_epsilon, duplicate_frames != 'keep', pyramid)
+        with open_droste_frame_pool(renderer, workers) as frame_pool:
+            # Reversed sections are rendered again backwards, a block of frames at a time
+            reverse_block_size = max(max_frames_in_flight, math.isqrt(renderer.frame_count))
+            if frame_pool is not None:
+                reversed_frames = lambda: frame_pool.iter_frames(reverse=True, reverse_block_size=reverse_block_size)
+            else:
+                reversed_frames = lambda: renderer.iter_frames_reversed(reverse_block_size)
+
+            def forward_frames():
+                frames = generate_droste_frames(image_path, shrink_factor, max_iterations, resampling_method, rotation_angle, renderer, frame_pool)
+                if frame_dir is not None:
+                    frames = save_droste_frames(frames, frame_dir)
+                if animation_writer is not None:
+                    frames = write_droste_animation(frames, animation_writer, renderer.frame_count)
+                return frames
+
+            frame_passes = {
+                'forward': lambda: stream_droste_frames(forward_frames(), max_frames_in_flight, result),
+                'reverse': lambda: (convert_video_frame(frame, iteration) for iteration, frame in reversed_frames()
+                                    if iteration not in renderer.skipped_frames),
+            }
+            retimed_frames = (renderer.frame_count, renderer.skipped_frames) if duplicate_frames == 'retime' else None
+            frame_count = encode_video_outputs(outputs, frame_passes, fps, max_frames_in_flight, retimed_frames, encoder_settings,
+                                               get_reverse_buffer_bytes(max_memory_mb))
+        if frame_count == 0:
+            return None
+
+        end_time = time.time()
+        print(f"Streamed {frame_count} frames to video in {end_time - start_time:.2f} seconds.")
+        if 'final_image' not in result:
+            result['final_image'] = renderer.render_frame(renderer.frame_count - 1)
+        return result['final_image']
+    except Exception as e:
+        print(f"Error in streaming Droste effect frames: {e}")
+        traceback.print_exc()
+        return None
+
+def plan_retimed_slots(passes, frame_count, skipped_frames):
+    # Slot, in frames, at which each frame written for an output starts once skipped duplicates are
+    # left out. A written frame is held over the slots of the identical frames next to it, which
+    # follow it going forward and come before it going backwards. A last entry repeats the final
+    # frame at the output's last slot, so the video keeps its full length.
+    slots = []
+    for pass_number, pass_name in enumerate(passes):
+        pass_start = pass_number * frame_count
+        if pass_name == 'forward':
+            slots.extend(pass_start + index for index in range(frame_count) if index not in skipped_frames)
+            continue
+        run_start = None
+        for slot, index in enumerate(range(frame_count - 1, -1, -1)):
+            if index in skipped_frames:
+                run_start = slot if run_start is None else run_start
+                continue
+            slots.append(pass_start + (slot if run_start is None else run_start))
+            run_start = None
+    last_slot = len(passes) * frame_count - 1
+    if slots and slots[-1] != last_slot:
+        slots.append(last_slot)
+    return slots
+
+def build_retime_ffmpeg_params(slots):
+    # setpts moves the n-th frame written to its slot; only the jumps over skipped frames need a term.
+    # Without B-frames and an MP4 edit list, the last frame is not cut off after a long jump.
+    terms = ['N'] + [f"gte(N,{n})*{slots[n] - slots[n - 1] - 1}" for n in range(1, len(slots)) if slots[n] - slots[n - 1] > 1]
+    return ['-vf', f"setpts='({'+'.join(terms)})/(FRAME_RATE*TB)'", '-fps_mode', 'passthrough', '-bf', '0', '-use_editlist', '0']
+
+def encode_video_outputs(outputs, frame_passes, fps, max_frames_in_flight=8, retimed_frames=None, encoder_settings=None, reverse_buffer_bytes=REVERSE_BUFFER_BYTES):
+    # Every pass over the frames is decoded once and fanned out to all the outputs that need it,
+    # while each output is encoded by its own ffmpeg process so independent encodes overlap
+    if not outputs:
+        return 0
+
+    # Split the encoder thread budget between the concurrent encodes instead of giving each one all of it
+    threads_per_output = max(1, ENCODER_THREAD_BUDGET // len(outputs))
+    end_of_stream = object()
+    encoders = []
+
+    def encode(output_path, frame_queue, errors, slots):
+        # With retimed_frames (the frame count and the skipped duplicates), frames are given the
+        # timestamps of the slots they cover instead of one slot each
+        writer = None
+        frames_written = 0
+        try:
+            while True:
+                frame = frame_queue.get()
+                if frame is end_of_stream:
+                    break
+                with profile_stage('encode'):
+                    if writer is None:
+                        writer = open_video_encoder(output_path, (frame.shape[1], frame.shape[0]), fps, encoder_settings, threads_per_output,
+                                                    build_retime_ffmpeg_params(slots) if slots else ())
+                    writer.write_frame(frame)
+                frames_written += 1
+                last_frame = frame
+            if writer is not None and frames_written < len(slots):
+                with profile_stage('encode'):
+                    writer.write_frame(last_frame)
+        except Exception as e:
+            errors.append(e)
+            # Keep draining so the scheduler never blocks on a failed encoder
+            while frame is not end_of_stream:
+                frame = frame_queue.get()
+        finally:
+            if writer is not None:
+                # Closing waits for ffmpeg to flush the frames it still buffers
+                with profile_stage('encode'):
+                    writer.close()
+                profile_file('videos', output_path)
+
+    errors = []
+    for output_path, passes in outputs:
+        frame_queue = queue.Queue(maxsize=max_frames_in_flight)
+        slots = plan_retimed_slots(passes, *retimed_frames) if retimed_frames and retimed_frames[1] else []
+        thread = threading.Thread(target=encode, args=(output_path, frame_queue, errors, slots), daemon=True)
+        thread.start()
+        encoders.append((frame_queue, list(passes), thread))
+
+    # The forward frames are only kept when a reversed section follows
+    frame_buffer = [] if reverse_buffer_bytes and any('reverse' in passes for _, passes in outputs) else None
+    buffered_bytes = 0
+    frame_count = 0
+    try:
+        for pass_name in ['forward', 'reverse']:
+            targets = []
+            for frame_queue, passes, _ in encoders:
+                if passes and passes[0] == pass_name:
+                    passes.pop(0)
+                    targets.append(frame_queue)
+            if not targets:
+                continue
+
+            pass_frame_count = 0
+            frames = reversed(frame_buffer) if pass_name == 'reverse' and frame_buffer else frame_passes[pass_name]()
+            for frame in frames:
+                if errors:
+                    raise errors[0]
+                for frame_queue in targets:
+                    frame_queue.put(frame)
+                pass_frame_count += 1
+                if pass_name == 'forward' and frame_buffer is not None:
+                    buffered_bytes += frame.nbytes
+                    if buffered_bytes <= reverse_buffer_bytes:
+                        frame_buffer.append(frame)
+                    else:
+                        frame_buffer = None
+            frame_count = max(frame_count, pass_frame_count)
+    finally:
+        for frame_queue, _, thread in encoders:
+            frame_queue.put(end_of_stream)
+        for frame_queue, _, thread in encoders:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return frame_count
+
+def load_video_frame(frame_path):
+    with profile_stage('frame_load'):
+        return np.asarray(Image.open(frame_path).convert('RGB'))
+
+def convert_video_frame(frame, iteration=None):
+    with profile_stage('frame_convert', iteration):
+        return np.asarray(frame.convert('RGB'))
+
+def create_videos(frame_paths, timelapse_video_path, reversed_clip_path, fps, include_reverse, save_reversed, max_frames_in_flight=8, retimed_frames=None, encoder_settings=None, max_memory_mb=None):
+    start_time = time.time()
+    if not frame_paths:
+        return False
+
+    try:
+        outputs = plan_video_outputs(timelapse_video_path, reversed_clip_path, include_reverse, save_reversed)
+        frame_passes = {
+            'forward': lambda: (load_video_frame(frame_path) for frame_path in frame_paths),
+            'reverse': lambda: (load_video_frame(frame_path) for frame_path in reversed(frame_paths)),
+        }
+        encode_video_outputs(outputs, frame_passes, fps, max_frames_in_flight, retimed_frames, encoder_settings,
+                             get_reverse_buffer_bytes(max_memory_mb))
+
+        end_time = time.time()
+        print(f"Video creation completed in {end_time - start_time:.2f} seconds.")
+        return True
+    except Exception as e:
+        print(f"Error in video creation: {e}")
+        traceback.print_exc()
+        return False
+
+def create_timelapse_video(frame_paths, output_filename, fps, include_reverse, encoder_settings=None):
+    try:
+        outputs = plan_video_outputs(output_filename, None, include_reverse, False)
+        frame_passes = {
+            'forward': lambda: (load_video_frame(frame_path) for frame_path in frame_paths),
+            'reverse': lambda: (load_video_frame(frame_path) for frame_path in reversed(frame_paths)),
+        }
+        encode_video_outputs(outputs, frame_passes, fps, encoder_settings=encoder_settings)
+    except Exception as e:
+        print(f"An error occurred during video creation: {e}")
+        raise
+
+    return True